@@ -44,6 +44,10 @@ import TextLoader
 # F frequency_penalty 1.0                option
 # A env envname=envvalue ～              option
 # A inline_mcp  FileTools Memory         option
+# B http_keep_alive   1                  option
+# I http_pool_size    8                  option
+# F http_idle_timeout 60.0               option
+# I tool_workers      4                  option
 # ======== preset-name1
 # S base_url    http://localhost:8080/v1 option
 # S provider    provider                 option
@@ -244,7 +248,7 @@ class Assistant:
 
     #--------------------------------------------------------------------------
 
-    def fallback( self, prompt, input_obj, session, preset_name ):
+    def fallback( self, prompt, input_obj, session, preset_name, callback= None ):
         options= self.load_preset2( preset_name, False )
         session.set_options( options )
         if 'model' in input_obj:
@@ -260,7 +264,7 @@ class Assistant:
 
         session.set_tools( options.tools )
 
-        response,status_code= self.common_api.generate2( session )
+        response,status_code= self.common_api.generate2( session, callback )
 
         if status_code != 200:
             print( 'Generate Error: %d' % status_code, flush=True )
@@ -271,7 +275,7 @@ class Assistant:
         response= header_text + response
         return  response,status_code,session,options
 
-    def generate_text2( self, input_obj, session= None ):
+    def generate_text2( self, input_obj, session= None, callback= None ):
         if session is None:
             session= CommonAPI.Session()
 
@@ -296,6 +300,8 @@ class Assistant:
         session.push_user( prompt )
         if 'model' in input_obj:
             options.model= input_obj['model']
+        if 'base_url' in input_obj:
+            options.base_url= input_obj['base_url']
         options.prompt= prompt
         session.set_env( self.options.env )
         session.set_env( options.env )
@@ -305,11 +311,11 @@ class Assistant:
 
         session.set_tools( options.tools )
 
-        response,status_code= self.common_api.generate2( session )
+        response,status_code= self.common_api.generate2( session, callback )
         if status_code != 200:
             while status_code == 408 and options.preset_fallback:
                 print( '###### Fallback %s ######' % options.preset_fallback )
-                response,status_code,session,options= self.fallback( prompt, input_obj, session, options.preset_fallback )
+                response,status_code,session,options= self.fallback( prompt, input_obj, session, options.preset_fallback, callback )
                 if status_code == 200:
                     return  response,status_code,session
             print( 'Generate Error: %d' % status_code, flush=True )
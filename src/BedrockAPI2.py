@@ -416,7 +416,7 @@ class BedrockAPI:
             print( 'Error: %d' % status_code, flush=True )
         return  None,status_code
 
-    def chat2( self, session ):
+    def chat2( self, session, callback= None ):
         options= session.get_options()
         toolbox= session.get_toolbox()
         self.initialize()
@@ -444,22 +444,30 @@ class BedrockAPI:
 
             if content and content.strip() != '':
                 response+= content + '\n'
+                if callback:
+                    callback( content + '\n' )
 
             if tool_calls:
                 toolresult= False
+                call_list= []
                 for tool_call in tool_calls:
-                    tool_call_id= tool_call['id']
                     function= tool_call['function']
                     func_name= function['name']
                     arguments= function['arguments']
-                    data= ''
                     if toolbox:
                         print( '**TOOLCALL**:', func_name, arguments, flush=True )
-                        data= toolbox.call_func( func_name, arguments, session.get_tool_env() )
+                    call_list.append( (func_name, arguments) )
+                result_list= [ '' ] * len(call_list)
+                if toolbox:
+                    result_list= toolbox.call_func_list( call_list, session.get_tool_env(), options.tool_workers )
+                for tool_call,(func_name,_),data in zip( tool_calls, call_list, result_list ):
+                    tool_call_id= tool_call['id']
                     session.push_result( data, func_name, tool_call_id )
                     toolresult= True
                     if options.response_all:
                         response+= '\U0001f527 toolcall: %s\n' % func_name
+                        if callback:
+                            callback( '\U0001f527 toolcall: %s\n' % func_name )
                 if toolresult:
                     continue
             break
@@ -5,7 +5,8 @@ import sys
 import os
 import time
 import threading
-from collections import deque
+import heapq
+from collections import deque, OrderedDict
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
@@ -15,14 +16,39 @@ import CommonAPI
 
 #------------------------------------------------------------------------------
 
+# 同じセッションの読み込みを 1 回にまとめる
+class SessionLoader:
+    def __init__( self ):
+        self.event= threading.Event()
+        self.session= None
+
+    def wait( self ):
+        self.event.wait()
+        return  self.session
+
+    def set( self, session ):
+        self.session= session
+        self.event.set()
+
+
 class SessionCache:
     SESSION_CACHE_DIR= 'threads'
     SESSION_QUEUE_SIZE= 20
+    MISSING_TTL= 30.0           # 存在しなかった session_id を覚えておく秒数
+    MISSING_SIZE= 1024
 
-    def __init__( self ):
+    # max_sessions = メモリに保持するセッション数 (0 なら SESSION_QUEUE_SIZE)
+    # max_bytes = メッセージの概算サイズの合計上限 (0 なら無制限)
+    def __init__( self, max_sessions= 0, max_bytes= 0 ):
         self.lock= threading.Lock()
-        self.session_map= {}
-        self.session_queue= []
+        self.session_map= OrderedDict()     # LRU 順。末尾が最新
+        self.size_map= {}                   # session_id to 計上済みのサイズ
+        self.total_bytes= 0
+        self.max_sessions= max_sessions if max_sessions > 0 else self.SESSION_QUEUE_SIZE
+        self.max_bytes= max_bytes
+        self.loading_map= {}                # session_id to SessionLoader
+        self.missing_map= OrderedDict()     # session_id to 確認した時刻
+        self.writer= None                   # SessionWriter (write_behind 時のみ)
         if not os.path.exists( self.SESSION_CACHE_DIR ):
             os.mkdir( self.SESSION_CACHE_DIR )
 
@@ -30,20 +56,67 @@ class SessionCache:
         params= session_id.split( '_' )
         return  os.path.join( self.SESSION_CACHE_DIR, params[0]+'_'+params[1], session_id + '.json' )
 
+    # Lock の外で呼ぶ
+    def load_session( self, session_id ):
+        # 書き込み待ちならディスクより新しい
+        if self.writer:
+            session= self.writer.get_pending( session_id )
+            if session:
+                return  session
+        session_filename= self.get_session_filename( session_id )
+        if not os.path.exists( session_filename ):
+            return  None
+        session= CommonAPI.Session( session_id )
+        session.load_session( session_filename )
+        session.lock= threading.Lock()
+        return  session
+
     #--------------------------------------------------------------------------
     # Lock の中から呼ぶ想定の命令
 
+    def is_missing_0( self, session_id ):
+        ts= self.missing_map.get( session_id )
+        if ts is None:
+            return  False
+        if time.monotonic() - ts < self.MISSING_TTL:
+            return  True
+        del self.missing_map[session_id]
+        return  False
+
+    def add_missing_0( self, session_id ):
+        self.missing_map[session_id]= time.monotonic()
+        self.missing_map.move_to_end( session_id )
+        while len(self.missing_map) > self.MISSING_SIZE:
+            self.missing_map.popitem( last=False )
+
+    def add_session_0( self, session_id, session ):
+        self.session_map[session_id]= session
+        self.missing_map.pop( session_id, None )
+        self.pop_queue_0( session_id )
+
+    def is_full_0( self ):
+        if len(self.session_map) > self.max_sessions:
+            return  True
+        return  self.max_bytes > 0 and self.total_bytes > self.max_bytes
+
+    def update_size_0( self, session_id ):
+        size= self.session_map[session_id].get_size()
+        self.total_bytes+= size - self.size_map.get( session_id, 0 )
+        self.size_map[session_id]= size
+
     # メモリ解放
     def pop_queue_0( self, session_id ):
-        if session_id in self.session_queue:
-            self.session_queue.remove( session_id )
-        self.session_queue.append( session_id )
-        while len(self.session_queue) > self.SESSION_QUEUE_SIZE:
-            pop_name= self.session_queue.pop(0)
-            if pop_name in self.session_map:
-                self.session_map[pop_name]= None
-                del self.session_map[pop_name]
-                print( 'Cache <<< %d >>> Removed %s' % (len(self.session_queue),pop_name) )
+        self.session_map.move_to_end( session_id )
+        self.update_size_0( session_id )
+        self.evict_0()
+
+    def evict_0( self ):
+        while len(self.session_map) > 1 and self.is_full_0():
+            pop_name,_= self.session_map.popitem( last=False )
+            self.total_bytes-= self.size_map.pop( pop_name, 0 )
+            if self.writer:
+                self.writer.flush_session( pop_name )
+            print( 'Cache <<< %d >>> Removed %s' % (len(self.session_map),pop_name) )
 
     def save_session_0( self, session ):
         session_id= session.get_id()
@@ -51,77 +124,338 @@ class SessionCache:
         p,_= os.path.split( save_file_name )
         if not os.path.exists( p ):
             os.makedirs( p )
-        session.save_session( save_file_name )
-
-    def has_session_0( self, session_id ):
-        if session_id in self.session_map:
-            if self.session_map[session_id]:
-                return  True
-        session_filename= self.get_session_filename( session_id )
-        if os.path.exists( session_filename ):
-            session= CommonAPI.Session( session_id )
-            session.load_session( session_filename )
-            session.lock= threading.Lock()
-            self.session_map[session_id]= session
-            return  True
-        return  False
+        session.append_session( save_file_name )
 
     #--------------------------------------------------------------------------
     # Lock する命令
 
-    def has_session( self, session_id ):
+    # メモリになければディスクから読み込む。存在しなければ None
+    # 読み込みは Lock の外で行い、同じ session_id への同時要求は 1 回の読み込みを待つ
+    def find_session( self, session_id ):
         with self.lock:
-            return  self.has_session_0( session_id )
+            if session_id in self.session_map:
+                return  self.session_map[session_id]
+            if self.is_missing_0( session_id ):
+                return  None
+            loader= self.loading_map.get( session_id )
+            owner= loader is None
+            if owner:
+                loader= SessionLoader()
+                self.loading_map[session_id]= loader
+        if not owner:
+            return  loader.wait()
+        session= None
+        try:
+            session= self.load_session( session_id )
+        finally:
+            with self.lock:
+                del self.loading_map[session_id]
+                if session_id in self.session_map:
+                    session= self.session_map[session_id]
+                elif session:
+                    self.add_session_0( session_id, session )
+                else:
+                    self.add_missing_0( session_id )
+            loader.set( session )
+        return  session
+
+    def has_session( self, session_id ):
+        return  self.find_session( session_id ) is not None
 
     def has_message( self, session_id, msg_id ):
-        with self.lock:
-            if self.has_session_0( session_id ):
-                session= self.session_map[session_id]
-                if session.get_info().get('msg_id','') == msg_id:
-                    return  True
-            return  False
+        session= self.find_session( session_id )
+        if session:
+            if session.get_info().get('msg_id','') == msg_id:
+                return  True
+        return  False
 
     def get_session( self, session_id ):
+        session= self.find_session( session_id )
         with self.lock:
-            if not self.has_session_0( session_id ):
-                session= CommonAPI.Session( session_id )
-                session.get_info()['date']= CommonAPI.ExecTime().get_date()
-                session.lock= threading.Lock()
-                self.session_map[session_id]= session
-            self.pop_queue_0( session_id )
+            if session_id not in self.session_map:
+                if session is None:
+                    session= CommonAPI.Session( session_id )
+                    session.get_info()['date']= CommonAPI.ExecTime().get_date()
+                    session.lock= threading.Lock()
+                self.add_session_0( session_id, session )
+            else:
+                self.pop_queue_0( session_id )
             return  self.session_map[session_id]
 
+    # 応答でセッションが大きくなったら計上し直す
+    def update_size( self, session ):
+        with self.lock:
+            session_id= session.get_id()
+            if self.session_map.get( session_id ) is session:
+                self.update_size_0( session_id )
+                self.evict_0()
+
+
+#------------------------------------------------------------------------------
+
+# 変更されたセッションをまとめて裏で保存する
+#   同じセッションへの複数回の更新は 1 回の書き込みになる
+#   最初の更新から delay 秒以内に保存する
+class SessionWriter(threading.Thread):
+    def __init__( self, session_cache, delay ):
+        super().__init__( daemon=True )
+        self.lock= threading.Condition()
+        self.session_cache= session_cache
+        self.delay= delay
+        self.dirty_map= OrderedDict()   # session_id to [session, 保存期限]
+        self.writing_map= {}            # 書き込み中の session_id to session
+        self.break_flag= False
+
+    def push_session( self, session ):
+        with self.lock:
+            session_id= session.get_id()
+            if session_id in self.dirty_map:
+                self.dirty_map[session_id][0]= session
+            else:
+                self.dirty_map[session_id]= [session, time.monotonic() + self.delay]
+                self.lock.notify()
+
+    # 書き込み中のものも返す。書き込みが終わるまではファイルが古い
+    def get_pending( self, session_id ):
+        with self.lock:
+            entry= self.dirty_map.get( session_id )
+            if entry:
+                return  entry[0]
+            return  self.writing_map.get( session_id )
+
+    # キャッシュから外れたセッションはすぐに保存する
+    def flush_session( self, session_id ):
+        with self.lock:
+            entry= self.dirty_map.get( session_id )
+            if entry:
+                entry[1]= 0
+                self.dirty_map.move_to_end( session_id, last=False )
+                self.lock.notify()
+
+    def pop_ready_0( self, force ):
+        ts= time.monotonic()
+        ready_list= []
+        for session_id,entry in list(self.dirty_map.items()):
+            if force or entry[1] <= ts:
+                ready_list.append( entry[0] )
+                del self.dirty_map[session_id]
+                self.writing_map[session_id]= entry[0]
+        return  ready_list
+
+    # 書き込めなかったものは再登録する
+    def done_session( self, session, saved ):
+        with self.lock:
+            session_id= session.get_id()
+            if self.writing_map.get( session_id ) is session:
+                del self.writing_map[session_id]
+            if not saved and session_id not in self.dirty_map:
+                self.dirty_map[session_id]= [session, time.monotonic() + self.delay]
+                self.lock.notify()
+
+    def wait_time_0( self ):
+        if not self.dirty_map:
+            return  None
+        deadline= min( entry[1] for entry in self.dirty_map.values() )
+        return  max( 0.0, deadline - time.monotonic() )
+
+    def save_session( self, session, blocking ):
+        saved= False
+        lock= session.get_lock()
+        # 応答生成中なら delay 後に再試行する
+        if lock.acquire( blocking=blocking ):
+            try:
+                self.session_cache.save_session_0( session )
+                saved= True
+            except Exception as e:
+                print( 'SessionWriter: save error %s: %s' % (session.get_id(), str(e)), flush=True )
+            finally:
+                lock.release()
+        self.done_session( session, saved )
+
+    def run( self ):
+        while True:
+            with self.lock:
+                while not self.break_flag:
+                    timeout= self.wait_time_0()
+                    if timeout == 0.0:
+                        break
+                    self.lock.wait( timeout=timeout )
+                if self.break_flag:
+                    break
+                ready_list= self.pop_ready_0( False )
+            for session in ready_list:
+                self.save_session( session, False )
+        self.flush()
+
+    # 残っているものをすべて書き込む
+    def flush( self ):
+        with self.lock:
+            ready_list= self.pop_ready_0( True )
+        for session in ready_list:
+            self.save_session( session, True )
+
+    def stop( self ):
+        with self.lock:
+            self.break_flag= True
+            self.lock.notify_all()
+        self.join()
+
 
 #------------------------------------------------------------------------------
 
+PRIORITY_INTERACTIVE= 0     # ユーザーへの返答
+PRIORITY_SCHEDULED= 1       # SchedulerWorker から投入された task
+PRIORITY_BACKGROUND= 2      # それ以外
+PRIORITY_NAMES= [ 'interactive', 'scheduled', 'background' ]
+
+# task.priority の小さい順に取り出す
+# task.key が同じ task は投入順に 1 つずつ実行する (key ごとのレーン)
+# key が異なる task や key を持たない task は並列に実行する
+#   実行中の key に来た task はレーンで待たせるので worker が Lock で止まらない
+# max_size を超えたときの動作 (policy)
+#   reject      = 新しい task を捨てる
+#   drop_oldest = 同じかより低い優先度の一番古い task を捨てる
+#   block       = 空くまで待つ
 class EventQueue:
-    def __init__( self ):
+    POLICY_LIST= [ 'reject', 'drop_oldest', 'block' ]
+
+    def __init__( self, max_size= 0, policy= 'reject' ):
+        if policy not in self.POLICY_LIST:
+            raise ValueError( 'Unknown queue policy: ' + policy )
         self.lock= threading.Condition()
-        self.queue= deque()
+        self.queue_list= [deque() for _ in PRIORITY_NAMES]     # [投入時刻, task]
+        self.lane_map= {}           # 実行中の key to 待機中の [投入時刻, task]
+        self.max_size= max_size
+        self.policy= policy
+        self.depth= 0               # 実行待ちの task 数 (レーンで待機中も含む)
         self.break_flag= False
+        self.stat_map= {
+            'max_depth': 0,
+            'dropped': 0,
+            'rejected': 0,
+            'blocked': 0,
+        }
+        self.wait_stat_list= [{ 'count': 0, 'total_wait': 0.0, 'max_wait': 0.0 } for _ in PRIORITY_NAMES]
+
+    def get_priority( self, event ):
+        priority= getattr( event, 'priority', PRIORITY_BACKGROUND )
+        return  min( max( priority, 0 ), len(PRIORITY_NAMES)-1 )
+
+    #--------------------------------------------------------------------------
+    # Lock の中から呼ぶ想定の命令
+
+    # block で待っている送信側もいるので全員起こす
+    def push_ready_0( self, entry ):
+        self.queue_list[self.get_priority( entry[1] )].append( entry )
+        self.lock.notify_all()
+
+    # 優先度が priority 以下の一番古い task を外す
+    def drop_oldest_0( self, priority ):
+        for level in range( len(self.queue_list)-1, priority-1, -1 ):
+            queue= self.queue_list[level]
+            if queue:
+                _,event= queue.popleft()
+                self.depth-= 1
+                self.stat_map['dropped']+= 1
+                key= getattr( event, 'key', None )
+                if key is not None:
+                    self.advance_lane_0( key )
+                return  event
+        return  None
+
+    def advance_lane_0( self, key ):
+        lane= self.lane_map.get( key )
+        if lane:
+            self.push_ready_0( lane.popleft() )
+        else:
+            self.lane_map.pop( key, None )
+
+    #--------------------------------------------------------------------------
 
     def pop_event( self ):
         with self.lock:
-            while len(self.queue) == 0 and not self.break_flag:
+            while self.depth_ready_0() == 0 and not self.break_flag:
                 self.lock.wait()
             if self.break_flag:
                 return  None
-            return  self.queue.popleft()
+            for level,queue in enumerate(self.queue_list):
+                if queue:
+                    ts,event= queue.popleft()
+                    break
+            self.depth-= 1
+            wait_time= time.monotonic() - ts
+            wait_stat= self.wait_stat_list[level]
+            wait_stat['count']+= 1
+            wait_stat['total_wait']+= wait_time
+            wait_stat['max_wait']= max( wait_stat['max_wait'], wait_time )
+            self.lock.notify_all()
+            return  event
 
+    def depth_ready_0( self ):
+        return  sum( len(queue) for queue in self.queue_list )
+
+    # 受け付けなかったら False (stop_all() 後も False)
     def send_event( self, event ):
+        dropped= None
         with self.lock:
-            self.queue.append( event )
-            self.lock.notify()
+            if self.max_size > 0 and self.depth >= self.max_size and not self.break_flag:
+                if self.policy == 'block':
+                    self.stat_map['blocked']+= 1
+                    while self.depth >= self.max_size and not self.break_flag:
+                        self.lock.wait()
+                elif self.policy == 'drop_oldest':
+                    dropped= self.drop_oldest_0( self.get_priority( event ) )
+            if self.break_flag or (self.max_size > 0 and self.depth >= self.max_size):
+                self.stat_map['rejected']+= 1
+                return  False
+            entry= [time.monotonic(), event]
+            self.depth+= 1
+            self.stat_map['max_depth']= max( self.stat_map['max_depth'], self.depth )
+            key= getattr( event, 'key', None )
+            if key is not None:
+                if key in self.lane_map:
+                    self.lane_map[key].append( entry )
+                    entry= None
+                else:
+                    self.lane_map[key]= deque()
+            if entry:
+                self.push_ready_0( entry )
+        if dropped:
+            print( 'EventQueue: dropped "%s"' % getattr( dropped, 'name', '' ), flush=True )
+            if hasattr( dropped, 'drop' ):
+                dropped.drop()
+        return  True
+
+    # task の実行が終わったら同じ key の次の task を流す
+    def done( self, event ):
+        key= getattr( event, 'key', None )
+        if key is None:
+            return
+        with self.lock:
+            self.advance_lane_0( key )
 
     def stop_all( self ):
         with self.lock:
             self.break_flag= True
             self.lock.notify_all()
 
-    def wait_break( self, timeout ):
+    def get_stats( self ):
         with self.lock:
-            self.lock.wait( timeout=timeout )
-            return  self.break_flag
+            stats= dict( self.stat_map )
+            stats['depth']= self.depth
+            stats['max_size']= self.max_size
+            stats['policy']= self.policy
+            stats['lanes']= len(self.lane_map)
+            for level,name in enumerate(PRIORITY_NAMES):
+                wait_stat= self.wait_stat_list[level]
+                count= wait_stat['count']
+                stats[name]= {
+                    'depth': len(self.queue_list[level]),
+                    'count': count,
+                    'avg_wait': wait_stat['total_wait'] / count if count else 0.0,
+                    'max_wait': wait_stat['max_wait'],
+                }
+            return  stats
 
 class TaskWorker(threading.Thread):
     def __init__( self, event_queue ):
@@ -133,55 +467,173 @@ class TaskWorker(threading.Thread):
             event= self.event_queue.pop_event()
             if event is None:
                 break
-            event.exec()
-
+            try:
+                event.exec()
+            except Exception as e:
+                print( 'TaskWorker: "%s" %s' % (getattr( event, 'name', '' ), str(e)), flush=True )
+            finally:
+                self.event_queue.done( event )
+
+# add_delayed_task() の戻り値。cancel() で取り消せる
+class ScheduledTask:
+    def __init__( self, task ):
+        self.task= task
+        self.cancelled= False
+        self.in_heap= False     # SchedulerWorker の heap に入っている
+
+    def cancel( self ):
+        self.cancelled= True
+
+
+# task.ts (time.time() の値) の小さい順に heap で管理する
+#   次の期限まで待機し、push_task() で起こされる
+#   繰り返し実行する task は次のどちらかを持つ
+#       task.interval = 実行間隔 (秒)
+#       task.next_ts( ts ) = ts の次の実行時刻を返す。None なら終了
 class SchedulerWorker(threading.Thread):
-    def __init__( self, queue, interval ):
+    COMPACT_MIN_SIZE= 1024
+
+    def __init__( self, queue ):
         super().__init__()
-        self.lock= threading.Lock()
+        self.lock= threading.Condition()
         self.event_queue= queue
-        self.interval= interval
-        self.delayed_task_list= []
+        self.task_heap= []          # (ts, seq, ScheduledTask)
+        self.seq= 0
+        self.cancel_count= 0
+        self.break_flag= False
 
     def ts_to_localfmt( self, ts ):
         return  time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime(ts) )
 
-    def scheduler( self ):
+    def get_next_ts( self, task, ts ):
+        if hasattr( task, 'next_ts' ):
+            return  task.next_ts( ts )
+        interval= getattr( task, 'interval', 0 )
+        if interval > 0:
+            next_ts= ts + interval
+            now= time.time()
+            if next_ts <= now:
+                # 遅れた分はまとめて 1 回にする
+                next_ts+= ((now - next_ts) // interval + 1) * interval
+            return  next_ts
+        return  None
+
+    #--------------------------------------------------------------------------
+    # Lock の中から呼ぶ想定の命令
+
+    def push_0( self, handle, ts ):
+        self.seq+= 1
+        handle.in_heap= True
+        heapq.heappush( self.task_heap, (ts, self.seq, handle) )
+        if self.task_heap[0][2] is handle:
+            self.lock.notify()
+
+    # 取り消された task が半分を超えたら作り直す
+    #   cancel_count は heap に残っている取り消し済みの task の数
+    def compact_0( self ):
+        if self.cancel_count < self.COMPACT_MIN_SIZE or self.cancel_count * 2 < len(self.task_heap):
+            return
+        task_heap= []
+        for entry in self.task_heap:
+            if entry[2].cancelled:
+                entry[2].in_heap= False
+            else:
+                task_heap.append( entry )
+        self.task_heap= task_heap
+        heapq.heapify( self.task_heap )
+        self.cancel_count= 0
+
+    def pop_0( self ):
+        entry= heapq.heappop( self.task_heap )
+        entry[2].in_heap= False
+        if entry[2].cancelled:
+            self.cancel_count-= 1
+        return  entry
+
+    def pop_ready_0( self ):
         ts= time.time()
         run_list= []
-        with self.lock:
-            for index,task in enumerate(self.delayed_task_list):
-                if task.ts <= ts:
-                    run_list.append( task )
-                    self.delayed_task_list[index]= None
-            if run_list != []:
-                task_list= []
-                for task in self.delayed_task_list:
-                    if task:
-                        task_list.append( task )
-                self.delayed_task_list= task_list
-        for task in run_list:
-            print( 'Run "%s" %s' % (task.name, self.ts_to_localfmt( task.ts )) )
-            self.event_queue.send_event( task )
+        while self.task_heap and self.task_heap[0][0] <= ts:
+            task_ts,_,handle= self.pop_0()
+            if handle.cancelled:
+                continue
+            run_list.append( (task_ts, handle) )
+        return  run_list
+
+    def wait_time_0( self ):
+        while self.task_heap and self.task_heap[0][2].cancelled:
+            self.pop_0()
+        if not self.task_heap:
+            return  None
+        return  max( 0.0, self.task_heap[0][0] - time.time() )
+
+    #--------------------------------------------------------------------------
 
     def run( self ):
-        while not self.event_queue.wait_break( timeout=self.interval ):
-            self.scheduler()
+        while True:
+            with self.lock:
+                while not self.break_flag:
+                    timeout= self.wait_time_0()
+                    if timeout == 0.0:
+                        break
+                    self.lock.wait( timeout=timeout )
+                if self.break_flag:
+                    break
+                run_list= self.pop_ready_0()
+            for task_ts,handle in run_list:
+                task= handle.task
+                print( 'Run "%s" %s' % (task.name, self.ts_to_localfmt( task_ts )) )
+                if not hasattr( task, 'priority' ):
+                    task.priority= PRIORITY_SCHEDULED
+                if not self.event_queue.send_event( task ):
+                    print( 'SchedulerWorker: rejected "%s"' % task.name, flush=True )
+                    if hasattr( task, 'drop' ):
+                        task.drop()
+                next_ts= self.get_next_ts( task, task_ts )
+                if next_ts is not None:
+                    with self.lock:
+                        if not handle.cancelled:
+                            task.ts= next_ts
+                            self.push_0( handle, next_ts )
 
     def push_task( self, task ):
         print( 'Add delayed task "%s" at %s' % (task.name, self.ts_to_localfmt(task.ts)) )
+        handle= ScheduledTask( task )
         with self.lock:
-            self.delayed_task_list.append( task )
+            self.push_0( handle, task.ts )
+        return  handle
+
+    def cancel_task( self, handle ):
+        with self.lock:
+            if handle.cancelled:
+                return
+            handle.cancel()
+            # 実行済みや実行中の task は heap に無いので数えない
+            if handle.in_heap:
+                self.cancel_count+= 1
+                self.compact_0()
+
+    def get_task_count( self ):
+        with self.lock:
+            return  len(self.task_heap) - self.cancel_count
+
+    def stop( self ):
+        with self.lock:
+            self.break_flag= True
+            self.lock.notify_all()
 
 
 class TaskManager:
     TASK_WORKER_COUNT= 4
-    SCHEDULAR_INTERVAL= 60
 
-    def __init__( self ):
+    # worker_count = 0 なら TASK_WORKER_COUNT
+    # queue_size = 実行待ちの task 数の上限 (0 なら無制限)
+    # queue_policy = 上限を超えたときの動作 (reject, drop_oldest, block)
+    def __init__( self, worker_count= 0, queue_size= 0, queue_policy= 'reject' ):
+        self.worker_count= worker_count if worker_count > 0 else self.TASK_WORKER_COUNT
         self.worker_list= []
         self.schedular_worker= None
-        self.event_queue= EventQueue()
+        self.event_queue= EventQueue( queue_size, queue_policy )
         self.initialize()
 
     def finalize( self ):
@@ -189,24 +641,37 @@ class TaskManager:
         for wk in self.worker_list:
             wk.join()
         self.worker_list.clear()
+        self.schedular_worker.stop()
         self.schedular_worker.join()
         print( 'TaskManager-Finalized', flush=True )
 
     def initialize( self ):
-        for _ in range( self.TASK_WORKER_COUNT ):
+        for _ in range( self.worker_count ):
             self.worker_list.append( TaskWorker( self.event_queue ) )
-        self.schedular_worker= SchedulerWorker( self.event_queue, self.SCHEDULAR_INTERVAL )
+        self.schedular_worker= SchedulerWorker( self.event_queue )
 
     def start( self ):
         for wk in self.worker_list:
             wk.start()
         self.schedular_worker.start()
 
+    # 受け付けなかったら False
     def add_task( self, task ):
-        self.event_queue.send_event( task )
+        return  self.event_queue.send_event( task )
 
+    # 戻り値を cancel_delayed_task() に渡すと取り消せる
     def add_delayed_task( self, task ):
-        self.schedular_worker.push_task( task )
+        return  self.schedular_worker.push_task( task )
+
+    def cancel_delayed_task( self, handle ):
+        self.schedular_worker.cancel_task( handle )
+
+    # キューの混雑状況
+    def get_stats( self ):
+        stats= self.event_queue.get_stats()
+        stats['workers']= len(self.worker_list)
+        stats['delayed']= self.schedular_worker.get_task_count()
+        return  stats
 
 
 #------------------------------------------------------------------------------
@@ -219,6 +684,16 @@ class ChatEngineOptions(Assistant.AssistantOptions):
         self.dm_enabled= False
         self.assistant_mode= False
         self.task_schedular= False
+        self.task_worker_count= 4
+        self.task_queue_size= 0             # 実行待ちの task 数の上限 (0 なら無制限)
+        self.task_queue_policy= 'reject'    # reject, drop_oldest, block
+        self.task_stats_interval= 600.0     # 混雑状況をログに出す間隔 (秒)。0 なら出さない
+        self.session_cache_size= 20         # メモリに保持するセッション数
+        self.session_cache_bytes= 0         # 保持するメッセージサイズの上限 (0 なら無制限)
+        self.stream_update= False           # Slack のメッセージを逐次更新する
+        self.stream_update_interval= 2.0
+        self.write_behind= False            # セッションの保存を裏で行う
+        self.write_behind_delay= 2.0        # 保存までの最大待ち時間 (秒)
         self.channel_allow_list= []         # channel-id or user-id
         self.channel_post_allow_list= []
         self.apply_params( args )
@@ -231,15 +706,26 @@ class ChatEngine:
         self.options= options
         self.task_manager= None
         if self.options.task_schedular:
-            self.task_manager= TaskManager()
+            self.task_manager= TaskManager( self.options.task_worker_count, self.options.task_queue_size, self.options.task_queue_policy )
             self.task_manager.start()
-        self.session_cache= SessionCache()
+            if self.options.task_stats_interval > 0:
+                self.task_manager.add_delayed_task( TaskStatsTask( self.task_manager, self.options.task_stats_interval ) )
+        self.session_cache= SessionCache( self.options.session_cache_size, self.options.session_cache_bytes )
+        self.session_writer= None
+        if self.options.write_behind:
+            self.session_writer= SessionWriter( self.session_cache, self.options.write_behind_delay )
+            self.session_cache.writer= self.session_writer
+            self.session_writer.start()
         self.assistant= Assistant.Assistant( options )
 
     def close( self ):
         if self.task_manager:
             self.task_manager.finalize()
             self.task_manager= None
+        if self.session_writer:
+            self.session_writer.stop()
+            self.session_cache.writer= None
+            self.session_writer= None
 
     #--------------------------------------------------------------------------
     # Assistant API
@@ -249,7 +735,8 @@ class ChatEngine:
         # prompt = ユーザー入力 (必須)
         # msg_id = 同一メッセージかどうか判定する場合のみ必要。不要なら ''
         # msg_info = スレッド(セッション)ログに記録したい情報。不要なら {}
-    def bot( self, session_id, prompt, msg_id, msg_info ):
+        # callback = 生成途中のテキストを受け取る関数。不要なら None
+    def bot( self, session_id, prompt, msg_id, msg_info, callback= None ):
         with CommonAPI.ExecTime( 'Generate' ):
             session= self.session_cache.get_session( session_id )
             with session.get_lock():
@@ -261,24 +748,91 @@ class ChatEngine:
                         input_obj= {
                             'prompt': prompt
                         }
-                        response,status_code,session= self.assistant.generate_text2( input_obj, session )
+                        response,status_code,session= self.assistant.generate_text2( input_obj, session, callback )
                         if status_code != 200:
                             response= '\nserver error: %d\n' % status_code
                     else:
                         response= '返答だよ'
                 finally:
-                    self.session_cache.save_session_0( session )
+                    if self.session_writer:
+                        self.session_writer.push_session( session )
+                    else:
+                        self.session_cache.save_session_0( session )
+                    self.session_cache.update_size( session )
         return  response
 
+    # bot() を TaskManager で実行する。task_schedular が無効ならその場で実行する
+    #   on_done = 返答を受け取る関数。処理済みのメッセージで返答が無い場合は None を渡す
+    #   同じセッションへの要求は順番に、別のセッションは並列に処理する
+    def post_bot( self, session_id, prompt, msg_id, msg_info, on_done, callback= None ):
+        task= ChatTask( self, session_id, prompt, msg_id, msg_info, on_done, callback )
+        if self.task_manager:
+            if not self.task_manager.add_task( task ):
+                task.drop()
+        else:
+            task.exec()
+
     def has_message( self, session_id, msg_id ):
         return  self.session_cache.has_message( session_id, msg_id )
 
+    # TaskManager の混雑状況。task_schedular が無効なら None
+    def get_task_stats( self ):
+        if self.task_manager:
+            return  self.task_manager.get_stats()
+        return  None
+
     def has_session( self, session_id ):
         return  self.session_cache.has_session( session_id )
 
 
 #------------------------------------------------------------------------------
 
+class ChatTask:
+    BUSY_MESSAGE= '\nserver busy\n'
+    ERROR_MESSAGE= '\nserver error\n'
+
+    def __init__( self, engine, session_id, prompt, msg_id, msg_info, on_done, callback ):
+        self.name= 'chat ' + session_id
+        self.key= session_id
+        self.priority= PRIORITY_INTERACTIVE
+        self.engine= engine
+        self.session_id= session_id
+        self.prompt= prompt
+        self.msg_id= msg_id
+        self.msg_info= msg_info
+        self.on_done= on_done
+        self.callback= callback
+
+    def exec( self ):
+        # レーンで待っている間に同じメッセージが処理済みになった
+        if self.msg_id != '' and self.engine.has_message( self.session_id, self.msg_id ):
+            self.on_done( None )
+            return
+        # 例外でも返答を返して placeholder を残さない
+        try:
+            response= self.engine.bot( self.session_id, self.prompt, self.msg_id, self.msg_info, self.callback )
+        except Exception as e:
+            print( 'ChatTask: "%s" %s' % (self.name, str(e)), flush=True )
+            response= self.ERROR_MESSAGE
+        self.on_done( response )
+
+    # キューがあふれて実行されなかった
+    def drop( self ):
+        self.on_done( self.BUSY_MESSAGE )
+
+
+# TaskManager の混雑状況を interval 秒ごとにログに出す
+class TaskStatsTask:
+    def __init__( self, task_manager, interval ):
+        self.name= 'task stats'
+        self.task_manager= task_manager
+        self.interval= interval
+        self.ts= time.time() + interval
+
+    def exec( self ):
+        print( 'TaskStats: %s' % str(self.task_manager.get_stats()), flush=True )
+
+
 class task_msg:
     def __init__( self, msg, ts= 0 ):
         self.name= msg
@@ -3,14 +3,20 @@
 
 import sys
 import os
+import re
+import time
 import json
+import hashlib
+import threading
+import queue
+import concurrent.futures
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
     sys.path.append( lib_path )
 import Assistant
 import FileListLib
-from Functions import get_toolbox
+from Functions import get_toolbox, ToolEnv
 import TextLoader
 import SlackAPI
 from CommonAPI import OptionBase, ExecTime
@@ -33,12 +39,21 @@ class AnalyzerOption(OptionBase):
         self.model= None
         self.debug= False
         self.limit= 0
+        self.jobs= 1
+        self.changed_only= False
+        self.resume= False
+        self.retry= 2                   # 失敗したファイルの再試行回数
+        self.max_failures= 5            # 連続してこの回数失敗したら中断する (0 なら中断しない)
+        self.batch_lines= 0             # この行数以下のファイルをまとめて解析する (0 ならまとめない)
+        self.order= ''                  # 解析順 recent,size,issues
+        self.time_limit= 0              # 解析を始める期限 (分)。0 なら無制限
         #---------------------------
         self.cache_file= 'slack_cache.json'
         self.channel= None
         self.nossl= False
         self.alias_file= None
         self.use_mention= False
+        self.post_jobs= 4
         #---------------------------
         self.apply_params( args )
 
@@ -55,10 +70,36 @@ class IssueList:
 
 issue_list= IssueList()
 
+# 並列に解析するときは解析ごとに IssueList を登録し、
+# 環境変数 CODE_ANALYZER_ISSUE_ID でどれに追加するか指定する
+ISSUE_ID_ENV= 'CODE_ANALYZER_ISSUE_ID'
+issue_list_lock= threading.Lock()
+issue_list_map= {}
+issue_list_serial= 0
+
+def register_issue_list():
+    global issue_list_serial
+    with issue_list_lock:
+        issue_list_serial+= 1
+        list_id= str(issue_list_serial)
+        issue_list_map[list_id]= IssueList()
+        return  list_id,issue_list_map[list_id]
+
+def unregister_issue_list( list_id ):
+    with issue_list_lock:
+        issue_list_map.pop( list_id, None )
+
+def get_issue_list( list_id ):
+    with issue_list_lock:
+        if list_id in issue_list_map:
+            return  issue_list_map[list_id]
+    global issue_list
+    return  issue_list
+
 mcp= get_toolbox()
 
-@mcp.tool()
-def create_issue( title:str, description:str, file_name:str ) -> str:
+@mcp.tool( serial=True )
+def create_issue( env:ToolEnv, title:str, description:str, file_name:str ) -> str:
     """Add a new issue to the bug tracking system.
 
     Args:
@@ -66,24 +107,91 @@ def create_issue( title:str, description:str, file_name:str ) -> str:
         description: Issue description. Please include identifiable information such as file names and line numbers in the description along with the details of the issue.
         file_name: Filename
     """
-    global issue_list
-    issue_id= issue_list.append( title, file_name, description )
+    target_list= get_issue_list( env.get( ISSUE_ID_ENV, '' ) )
+    issue_id= target_list.append( title, file_name, description )
     print( 'New Issue: %s (%s)' % (title,file_name) )
     print( '  desc: %s' % title, flush=True )
     return  'Issue created : "%s" id=%d' % (title,issue_id)
 
 #------------------------------------------------------------------------------
 
+# load_json で読み込んだファイル情報の検索用
+#   フルパス、正規化したパス (区切り '/', 大文字小文字無視)、ファイル名で引く
+#   同じファイル名が複数ある場合は末尾のディレクトリが最も多く一致するもの、
+#   同数なら先に読み込んだものを返す
+class FileInfoIndex:
+    def __init__( self, file_map= None ):
+        self.file_map= {}
+        self.norm_map= {}       # 正規化したパス to entry
+        self.base_map= {}       # basename to [(分解したパス, entry)]
+        if file_map:
+            for file_name,entry in file_map.items():
+                self.add( file_name, entry )
+
+    def normalize( self, file_name ):
+        return  file_name.replace( '\\', '/' ).casefold()
+
+    def split_path( self, file_name ):
+        return  [name for name in self.normalize( file_name ).split( '/' ) if name not in ('', '.')]
+
+    def add( self, file_name, entry ):
+        self.file_map[file_name]= entry
+        self.norm_map.setdefault( self.normalize( file_name ), entry )
+        path_list= self.split_path( file_name )
+        if path_list:
+            self.base_map.setdefault( path_list[-1], [] ).append( (path_list, entry) )
+
+    def get_suffix_length( self, path_a, path_b ):
+        length= 0
+        for name_a,name_b in zip( reversed(path_a), reversed(path_b) ):
+            if name_a != name_b:
+                break
+            length+= 1
+        return  length
+
+    def find( self, file_name ):
+        if file_name in self.file_map:
+            return  self.file_map[file_name]
+        entry= self.norm_map.get( self.normalize( file_name ) )
+        if entry is not None:
+            return  entry
+        path_list= self.split_path( file_name )
+        if not path_list:
+            return  None
+        candidate_list= self.base_map.get( path_list[-1] )
+        if not candidate_list:
+            return  None
+        if len(candidate_list) == 1:
+            return  candidate_list[0][1]
+        best_entry= None
+        best_length= -1
+        for candidate_path,entry in candidate_list:
+            length= self.get_suffix_length( path_list, candidate_path )
+            if length > best_length:
+                best_length= length
+                best_entry= entry
+        return  best_entry
+
+#------------------------------------------------------------------------------
+
 class CodeAnalyzer:
     def __init__( self, options ):
         self.options= options
         self.file_list= None
         self.file_map= {}
+        self.file_index= FileInfoIndex()
         self.uemode= options.project is not None
+        self.lock= threading.Lock()
+        # --host はカンマ区切りで複数指定できる。並列解析時に振り分ける
+        self.endpoint_list= [None]
+        if options.base_url:
+            self.endpoint_list= [url.strip() for url in options.base_url.split(',') if url.strip()]
+        self.endpoint_queue= None
+        self.stop_flag= False
         options= Assistant.AssistantOptions(
                     prompt_dir=options.prompt_dir,
                     config_file=options.config_file,
-                    base_url=options.base_url,
+                    base_url=self.endpoint_list[0],
                     provider=options.provider,
                     model=options.model,
                     timeout=60*20
@@ -96,6 +204,81 @@ class CodeAnalyzer:
         self.stat_issue_files= []
         self.stat_total_issues= 0
         self.stat_analyze_time= ExecTime().get_date()
+        self.cache_map= {}
+        self.cache_salt= None
+        self.stat_cache_hit= 0
+        self.stat_cache_miss= 0
+        self.state= None
+        self.state_dirty= 0
+        self.state_save_time= 0.0
+        self.consecutive_failures= 0
+        self.deadline= None
+
+    #--------------------------------------------------------------------------
+    # 解析キャッシュ
+    #   log_dir/.analyzer_cache.json
+    #   { "source": { "hash": ソース・preset・model・prompt の sha256, "log": ログファイル, "issue_count": n } }
+
+    CACHE_FILE= '.analyzer_cache.json'
+
+    def get_cache_file( self ):
+        return  os.path.join( self.options.log_dir, self.CACHE_FILE )
+
+    def load_cache( self ):
+        cache_file= self.get_cache_file()
+        if os.path.exists( cache_file ):
+            try:
+                with open( cache_file, 'r', encoding='utf-8' ) as fi:
+                    self.cache_map= json.loads( fi.read() )
+            except (OSError, ValueError) as e:
+                print( 'cache error: %s' % str(e) )
+                self.cache_map= {}
+        local_options= self.assistant.load_preset2( self.options.preset, True )
+        salt= [ self.options.preset ]
+        if local_options:
+            salt+= [ str(local_options.model), str(local_options.system_prompt), str(local_options.base_prompt) ]
+        self.cache_salt= '\n'.join( salt ).encode( 'utf-8' )
+
+    def save_cache( self ):
+        log_dir= self.options.log_dir
+        if not os.path.exists( log_dir ):
+            os.makedirs( log_dir )
+        cache_file= self.get_cache_file()
+        with self.lock:
+            data= json.dumps( self.cache_map, indent=4, ensure_ascii=False )
+        with open( cache_file + '.tmp', 'w', encoding='utf-8' ) as fo:
+            fo.write( data )
+        os.replace( cache_file + '.tmp', cache_file )
+
+    # 読めないファイルがあれば None
+    def get_source_hash( self, file_list ):
+        sha= hashlib.sha256( self.cache_salt )
+        for file_name in file_list:
+            try:
+                with open( file_name, 'rb' ) as fi:
+                    data= fi.read()
+            except OSError:
+                return  None
+            sha.update( b'\0' + file_name.encode( 'utf-8' ) + b'\0' )
+            sha.update( data )
+        return  sha.hexdigest()
+
+    def find_cache( self, file_list, source_hash ):
+        with self.lock:
+            entry= self.cache_map.get( file_list[0] )
+        if entry is None or entry.get( 'hash' ) != source_hash:
+            return  None
+        log_file= entry.get( 'log', '' )
+        if not os.path.exists( log_file ):
+            return  None
+        # 別のファイルのログで上書きされていないか確認する
+        try:
+            log_obj= TextLoader.TextLoader().load( log_file )
+        except Exception:
+            return  None
+        if log_obj is None or log_obj.get( 'default', {} ).get( 'file_name' ) != file_list[0]:
+            return  None
+        return  entry
 
     #--------------------------------------------------------------------------
 
@@ -168,13 +351,7 @@ class CodeAnalyzer:
     def get_file_info( self, file_name ):
         if file_name == '':
             return  None
-        if file_name in self.file_map:
-            return  self.file_map[file_name]
-        base_name= os.path.basename(file_name)
-        for key in self.file_map:
-            if base_name == os.path.basename(key):
-                return  self.file_map[key]
-        return  None
+        return  self.file_index.find( file_name )
 
     def set_file_info( self, dest_obj, file_name, user_list ):
         file_info= self.get_file_info( file_name )
@@ -218,8 +395,9 @@ class CodeAnalyzer:
         log_obj['default']= default_obj
 
         if issue_count != 0:
-            self.stat_issue_files.append( file_list[0] )
-            self.stat_total_issues+= issue_count
+            with self.lock:
+                self.stat_issue_files.append( file_list[0] )
+                self.stat_total_issues+= issue_count
 
         for issue in issue_list.logs:
             issue_id= issue[0]
@@ -239,13 +417,73 @@ class CodeAnalyzer:
         log_dir= self.options.log_dir
         if not os.path.exists( log_dir ):
             os.makedirs( log_dir )
-        output_file= '%s/%s.txt' % (log_dir, os.path.basename(file_list[0]) )
+        output_file= '%s/%s.txt' % (log_dir, self.get_log_name( file_list[0] ) )
         TextLoader.TextLoader().save( output_file, log_obj )
-
-    def analyze_1( self, file_list ):
+        return  output_file
+
+    # root からの相対パス (区切りは '/')
+    def get_rel_path( self, file_name ):
+        root= os.path.abspath( self.get_root_folder() )
+        full_path= os.path.abspath( file_name )
+        if full_path.startswith( root + os.sep ):
+            rel_path= full_path[len(root)+1:]
+        else:
+            rel_path= os.path.splitdrive( full_path )[1].lstrip( os.sep )
+        return  rel_path.replace( '\\', '/' )
+
+    # root からの相対パスをログのファイル名にする
+    #   a/Util.cpp → a__Util.cpp
+    def get_log_name( self, file_name ):
+        return  self.get_rel_path( file_name ).replace( '/', '__' )
+
+    # バッチ内のファイルの相対パス to ユニット番号
+    #   同じファイル名があっても末尾のディレクトリが最も多く一致するユニットを選ぶ
+    def make_unit_index( self, unit_list ):
+        unit_index= FileInfoIndex()
+        for index,file_list in enumerate(unit_list):
+            for file_name in file_list:
+                unit_index.add( self.get_rel_path( file_name ), index )
+        return  unit_index
+
+    # issue の file_name からどのユニットのものか決める。見つからなければ先頭
+    def find_unit_index( self, unit_list, unit_index, file_name ):
+        index= unit_index.find( file_name )
+        if index is not None:
+            return  index
+        if len(unit_list) != 1:
+            print( 'unknown issue file: %s' % file_name, flush=True )
+        return  0
+
+    SECTION_PROMPT= '\nファイルごとに "## ファイルのパス" の見出しを付けて結果を書いてください。\n'
+    _RE_SECTION_PATH= re.compile( r'[\w.:/\\-]+\.\w+' )
+
+    # バッチの返答を "## パス" の見出しでユニットごとに分ける
+    #   見出しが無いユニットには、どの見出しにも属さない部分を入れる
+    def split_response( self, response, unit_count, unit_index ):
+        section_list= [[] for _ in range(unit_count)]
+        common_list= []
+        current= common_list
+        for line in response.splitlines( True ):
+            if line.startswith( '#' ):
+                m= self._RE_SECTION_PATH.search( line )
+                index= unit_index.find( m.group( 0 ) ) if m else None
+                if index is not None:
+                    current= section_list[index]
+            current.append( line )
+        common= ''.join( common_list )
+        return  [''.join( section ) if section else common for section in section_list]
+
+    # unit_list = 1 回のセッションでまとめて解析する [ [cpp, h], .. ]
+    # 成功したらユニットごとの issue 数のリスト、失敗したら None
+    def analyze_1( self, unit_list, hash_list= None ):
         prompt_text= ''
-        for file_name in file_list:
-            prompt_text+= '- %s\n' % os.path.basename(file_name)
+        batch= len(unit_list) > 1
+        for file_list in unit_list:
+            for file_name in file_list:
+                # バッチでは同じファイル名を区別できるように相対パスにする
+                prompt_text+= '- %s\n' % (self.get_rel_path( file_name ) if batch else os.path.basename( file_name ))
+        if batch:
+            prompt_text+= self.SECTION_PROMPT
         env_array= []
         if self.options.project:
             env_array.append( 'MCP_PROJECT_ROOT=%s' % self.options.project )
@@ -253,30 +491,311 @@ class CodeAnalyzer:
                 env_array.append( 'MCP_ENGINE_ROOT=%s' % self.options.engine )
         else:
             env_array.append( 'MCP_SOURCE_ROOT=%s' % self.options.root )
+        list_id,local_issue_list= register_issue_list()
+        env_array.append( '%s=%s' % (ISSUE_ID_ENV, list_id) )
         input_obj= {
             'preset': self.options.preset,
             'prompt': prompt_text,
             'env': env_array,
         }
+        endpoint= self.endpoint_queue.get() if self.endpoint_queue else self.endpoint_list[0]
+        if endpoint:
+            input_obj['base_url']= endpoint
         if self.options.debug:
             print( 'input:', input_obj )
 
-        global issue_list
-        issue_list= IssueList()
-
-        with ExecTime( 'Generate' ):
-            response,status_code,session= self.assistant.generate_text2( input_obj )
-            local_options= session.get_options()
+        try:
+            with ExecTime( 'Generate' ):
+                response,status_code,session= self.assistant.generate_text2( input_obj )
+                local_options= session.get_options()
+        finally:
+            unregister_issue_list( list_id )
+            if self.endpoint_queue:
+                self.endpoint_queue.put( endpoint )
 
         if status_code != 200:
-            return  False
+            return  None
 
-        self.save_logs( response, local_options.prompt, file_list, issue_list )
-        return  True
+        # ユニットごとにログを分ける
+        unit_index= self.make_unit_index( unit_list )
+        unit_issue_list= [IssueList() for _ in unit_list]
+        for _,title,file_name,description in local_issue_list.logs:
+            unit_issue_list[self.find_unit_index( unit_list, unit_index, file_name )].append( title, file_name, description )
+        response_list= [response]
+        if batch:
+            response_list= self.split_response( response, len(unit_list), unit_index )
+
+        count_list= []
+        for index,file_list in enumerate(unit_list):
+            issue_list= unit_issue_list[index]
+            output_file= self.save_logs( response_list[index], local_options.prompt, file_list, issue_list )
+            if hash_list and hash_list[index]:
+                with self.lock:
+                    # 以前の名前のログが残っていると post で重複するので消す
+                    old_entry= self.cache_map.get( file_list[0] )
+                    if old_entry and old_entry.get( 'log' ) != output_file and os.path.exists( old_entry.get( 'log', '' ) ):
+                        os.remove( old_entry['log'] )
+                    self.cache_map[file_list[0]]= {
+                            'hash': hash_list[index],
+                            'log': output_file,
+                            'issue_count': len(issue_list.logs),
+                        }
+            count_list.append( len(issue_list.logs) )
+        return  count_list
+
+    #--------------------------------------------------------------------------
+    # 小さいファイルをまとめる
+    #   batch_lines 行以下のユニットを合計 batch_lines 行まで 1 回のセッションにする
+
+    BATCH_MAX_UNITS= 8
+
+    def count_lines( self, file_list ):
+        line_count= 0
+        for file_name in file_list:
+            try:
+                with open( file_name, 'rb' ) as fi:
+                    line_count+= fi.read().count( b'\n' ) + 1
+            except OSError:
+                pass
+        return  line_count
+
+    def make_batches( self, task_list ):
+        batch_lines= self.options.batch_lines
+        if batch_lines <= 0:
+            return  [ [file_list] for file_list in task_list ]
+        batch_list= []
+        current= []
+        current_lines= 0
+        for file_list in task_list:
+            line_count= self.count_lines( file_list )
+            if line_count > batch_lines:
+                batch_list.append( [file_list] )
+                continue
+            if current and (current_lines + line_count > batch_lines or len(current) >= self.BATCH_MAX_UNITS):
+                batch_list.append( current )
+                current= []
+                current_lines= 0
+            current.append( file_list )
+            current_lines+= line_count
+        if current:
+            batch_list.append( current )
+        return  batch_list
+
+    #--------------------------------------------------------------------------
+    # 進捗の記録
+    #   log_dir/.analyzer_state.json
+    #   { "time": 開始時刻, "completed": { "source": issue_count }, "failed": { "source": 失敗回数 } }
+    #   --resume で completed を飛ばして続きから解析する。すべて終われば削除する
+    #   毎回書き直すと O(n^2) になるので、STATE_SAVE_COUNT 件か STATE_SAVE_INTERVAL 秒ごと、失敗時、終了時に書く
+
+    STATE_FILE= '.analyzer_state.json'
+    STATE_SAVE_COUNT= 50
+    STATE_SAVE_INTERVAL= 30     # (秒)
+    RETRY_WAIT= 30      # 再試行までの待ち時間 (秒)。回数ごとに倍にする
+
+    def get_state_file( self ):
+        return  os.path.join( self.options.log_dir, self.STATE_FILE )
+
+    def load_state( self ):
+        self.state= { 'time': self.stat_analyze_time, 'completed': {}, 'failed': {} }
+        state_file= self.get_state_file()
+        if not self.options.resume or not os.path.exists( state_file ):
+            return
+        try:
+            with open( state_file, 'r', encoding='utf-8' ) as fi:
+                state= json.loads( fi.read() )
+        except (OSError, ValueError) as e:
+            print( 'state error: %s' % str(e) )
+            return
+        self.state.update( state )
+        self.stat_analyze_time= self.state['time']
+        print( 'resume: %d completed, %d failed' % (len(self.state['completed']), len(self.state['failed'])), flush=True )
+
+    def save_state_0( self ):
+        log_dir= self.options.log_dir
+        if not os.path.exists( log_dir ):
+            os.makedirs( log_dir )
+        state_file= self.get_state_file()
+        with open( state_file + '.tmp', 'w', encoding='utf-8' ) as fo:
+            fo.write( json.dumps( self.state, indent=4, ensure_ascii=False ) )
+        os.replace( state_file + '.tmp', state_file )
+        self.state_dirty= 0
+        self.state_save_time= time.time()
+
+    # 溜まった更新を書く。force でなければ件数か時間が閾値を超えたときだけ
+    def flush_state_0( self, force= False ):
+        if self.state_dirty == 0:
+            return
+        if force or self.state_dirty >= self.STATE_SAVE_COUNT or time.time() - self.state_save_time >= self.STATE_SAVE_INTERVAL:
+            self.save_state_0()
+
+    def flush_state( self ):
+        with self.lock:
+            self.flush_state_0( True )
+
+    def add_result_0( self, file_name, issue_count ):
+        self.stat_analyzed_files.append( file_name )
+        if issue_count != 0:
+            self.stat_issue_files.append( file_name )
+            self.stat_total_issues+= issue_count
+
+    def set_completed( self, file_name, issue_count ):
+        with self.lock:
+            self.consecutive_failures= 0
+            self.state['completed'][file_name]= issue_count
+            self.state['failed'].pop( file_name, None )
+            self.state_dirty+= 1
+            self.flush_state_0()
+
+    # 連続して max_failures 回失敗したらサーバーが止まっているとみなして中断する
+    def set_failed( self, file_name_list ):
+        with self.lock:
+            self.consecutive_failures+= 1
+            for file_name in file_name_list:
+                self.state['failed'][file_name]= self.state['failed'].get( file_name, 0 ) + 1
+            self.state_dirty+= 1
+            self.flush_state_0( True )
+            if self.options.max_failures > 0 and self.consecutive_failures >= self.options.max_failures:
+                if not self.stop_flag:
+                    print( 'Stop: %d consecutive failures' % self.consecutive_failures, flush=True )
+                self.stop_flag= True
+
+    #--------------------------------------------------------------------------
+
+    def analyze_task( self, unit_list ):
+        if self.stop_flag or self.is_time_over():
+            return
+        pending_list= []
+        hash_list= []
+        for file_list in unit_list:
+            source_hash= self.get_source_hash( file_list )
+            # 変更がなければ前回のログをそのまま使う
+            if self.options.changed_only and source_hash:
+                entry= self.find_cache( file_list, source_hash )
+                if entry:
+                    print( 'unchanged: %s' % file_list[0], flush=True )
+                    issue_count= entry.get( 'issue_count', 0 )
+                    with self.lock:
+                        self.stat_cache_hit+= 1
+                        self.add_result_0( file_list[0], issue_count )
+                    self.set_completed( file_list[0], issue_count )
+                    continue
+                with self.lock:
+                    self.stat_cache_miss+= 1
+            pending_list.append( file_list )
+            hash_list.append( source_hash )
+        if pending_list == []:
+            return
+        count_list= self.analyze_1( pending_list, hash_list )
+        if count_list is None:
+            print( 'failed: %s' % ' '.join( file_list[0] for file_list in pending_list ), flush=True )
+            self.set_failed( [file_list[0] for file_list in pending_list] )
+            return
+        for file_list,issue_count in zip( pending_list, count_list ):
+            with self.lock:
+                self.stat_analyzed_files.append( file_list[0] )
+            self.set_completed( file_list[0], issue_count )
+
+    def run_tasks( self, task_list ):
+        jobs= max( 1, self.options.jobs )
+        if jobs == 1:
+            for analyze_list in task_list:
+                self.analyze_task( analyze_list )
+                if self.stop_flag:
+                    break
+        else:
+            # 各 endpoint を同時に使う数が均等になるように貸し出す
+            self.endpoint_queue= queue.Queue()
+            for index in range( jobs ):
+                self.endpoint_queue.put( self.endpoint_list[index % len(self.endpoint_list)] )
+            with concurrent.futures.ThreadPoolExecutor( max_workers=jobs ) as executor:
+                list( executor.map( self.analyze_task, task_list ) )
+            self.endpoint_queue= None
+
+    #--------------------------------------------------------------------------
+    # 解析順
+    #   --order recent,size,issues の順に比較し、どれも大きいものを先に解析する
+    #       recent = 更新日時 (リストの date、無ければファイルの mtime)
+    #       size = ファイルサイズ
+    #       issues = 前回の issue 数
+
+    ORDER_KEY_LIST= [ 'recent', 'size', 'issues' ]
+
+    DATE_FORMAT_LIST= [ '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d' ]
+
+    # file_info の date (epoch または日付文字列) を time.time() の値にする。読めなければ None
+    def parse_date( self, date ):
+        if isinstance( date, (int,float) ):
+            return  float(date)
+        date= str(date).strip()
+        try:
+            return  float(date)
+        except ValueError:
+            pass
+        for date_format in self.DATE_FORMAT_LIST:
+            try:
+                return  time.mktime( time.strptime( date, date_format ) )
+            except ValueError:
+                pass
+        return  None
+
+    def get_order_value( self, order, file_list ):
+        if order == 'recent':
+            file_info= self.get_file_info( file_list[0] )
+            if file_info and file_info.get( 'date' ):
+                date= self.parse_date( file_info['date'] )
+                if date is not None:
+                    return  date
+            try:
+                return  os.path.getmtime( file_list[0] )
+            except OSError:
+                return  0.0
+        if order == 'size':
+            size= 0
+            for file_name in file_list:
+                try:
+                    size+= os.path.getsize( file_name )
+                except OSError:
+                    pass
+            return  size
+        if order == 'issues':
+            entry= self.cache_map.get( file_list[0] )
+            if entry:
+                return  entry.get( 'issue_count', 0 )
+            return  self.state['completed'].get( file_list[0], 0 )
+        return  0
+
+    def sort_tasks( self, task_list ):
+        order_list= [order.strip() for order in self.options.order.split( ',' ) if order.strip()]
+        for order in order_list:
+            if order not in self.ORDER_KEY_LIST:
+                print( 'Error: unknown order %s' % order )
+                return  task_list
+        if order_list == []:
+            return  task_list
+        return  sorted( task_list, key=lambda file_list: tuple( self.get_order_value( order, file_list ) for order in order_list ), reverse=True )
+
+    # --time_limit を過ぎたら新しい解析を始めない
+    def is_time_over( self ):
+        if self.deadline and time.time() >= self.deadline:
+            if not self.stop_flag:
+                print( 'Stop: time limit %d min' % self.options.time_limit, flush=True )
+            self.stop_flag= True
+            return  True
+        return  False
+
+    #--------------------------------------------------------------------------
 
     def analyze( self, file_list ):
+        self.load_cache()
+        self.load_state()
+        self.state_save_time= time.time()
+        self.consecutive_failures= 0
+        if self.options.time_limit > 0:
+            self.deadline= time.time() + self.options.time_limit * 60
         with ExecTime( 'Analyze' ):
             file_set= set(file_list)
+            task_list= []
             for file_name in file_list:
                 base,ext= os.path.splitext( file_name )
                 if ext == '.cpp':
@@ -284,23 +803,61 @@ class CodeAnalyzer:
                     header_file= base + '.h'
                     if header_file in file_set:
                         analyze_list.append( header_file )
-                    if not self.analyze_1( analyze_list ):
+                    task_list.append( analyze_list )
+            task_list= self.sort_tasks( task_list )
+            if self.options.limit != 0 and len(task_list) > self.options.limit:
+                print( '%d limit reached' % self.options.limit )
+                task_list= task_list[:self.options.limit]
+            # 前回完了したものは結果だけ集計する
+            completed_map= self.state['completed']
+            pending_list= []
+            for analyze_list in task_list:
+                if analyze_list[0] in completed_map:
+                    self.add_result_0( analyze_list[0], completed_map[analyze_list[0]] )
+                else:
+                    pending_list.append( analyze_list )
+            try:
+                self.run_tasks( self.make_batches( pending_list ) )
+                # 失敗したものは間隔を空けて再試行する
+                for retry in range( self.options.retry ):
+                    if self.stop_flag:
                         break
-                    self.stat_analyzed_files.append( file_name )
-                    if self.options.limit != 0:
-                        if len(self.stat_analyzed_files) >= self.options.limit:
-                            print( '%d limit reached' % self.options.limit )
-                            break
+                    retry_list= [analyze_list for analyze_list in pending_list if analyze_list[0] in self.state['failed']]
+                    if retry_list == []:
+                        break
+                    wait_time= self.RETRY_WAIT * (2 ** retry)
+                    if self.deadline and time.time() + wait_time >= self.deadline:
+                        break
+                    print( 'Retry %d: %d files after %d sec' % (retry+1, len(retry_list), wait_time), flush=True )
+                    time.sleep( wait_time )
+                    self.consecutive_failures= 0
+                    self.run_tasks( self.make_batches( retry_list ) )
+            finally:
+                # 中断や例外で抜けたときも --resume できるように残りを書く
+                self.flush_state()
+        self.save_cache()
+        failed_count= len(self.state['failed'])
+        pending_count= sum( 1 for analyze_list in task_list if analyze_list[0] not in self.state['completed'] )
+        if pending_count == 0 and os.path.exists( self.get_state_file() ):
+            os.remove( self.get_state_file() )
         analyzed_count= len(self.stat_analyzed_files)
         issue_file_count= len(self.stat_issue_files)
         print( 'Analyzed: %d files' % analyzed_count )
         print( 'Issues: %d (%d files)' % (self.stat_total_issues,issue_file_count), flush=True )
+        if self.options.changed_only:
+            print( 'Cache: hit %d miss %d' % (self.stat_cache_hit,self.stat_cache_miss), flush=True )
+        if pending_count != 0:
+            print( 'Incomplete: %d files (%d failed). Use --resume to continue' % (pending_count,failed_count), flush=True )
         result_file_name= 'analyzer_stat.json'
         self.save_json( result_file_name, {
                 'analyzed_count': analyzed_count,
                 'issue_file_count': issue_file_count,
                 'total_issues': self.stat_total_issues,
                 'time': self.stat_analyze_time,
+                'cache_hit': self.stat_cache_hit,
+                'cache_miss': self.stat_cache_miss,
+                'failed_count': failed_count,
+                'pending_count': pending_count,
                 'root': self.options.project if self.options.project else self.options.root
             })
         if self.options.debug:
@@ -324,6 +881,7 @@ class CodeAnalyzer:
             self.file_list,self.file_map= self.load_json( list_file )
         else:
             self.file_list,self.file_map= self.load_list( list_file )
+        self.file_index= FileInfoIndex( self.file_map )
 
     def f_clear_logdir( self ):
         log_dir= self.options.log_dir
@@ -348,8 +906,13 @@ class CodeAnalyzer:
 #------------------------------------------------------------------------------
 
 class PostTool:
+    PROGRESS_FILE= '.post_progress.json'
+    INFO_KEY= '.info'
+
     def __init__( self, options ):
         self.options= options
+        self.lock= threading.Lock()
+        self.progress= None
         token= os.environ.get( 'SLACK_API_TOKEN', None )
         if token is None:
             print( 'SLACK_API_TOKEN not found in environment variables.' )
@@ -382,10 +945,11 @@ class PostTool:
         user_list= ['<'+user+'>' for user in user_list]
         return  user_list
 
-    def post_info( self ):
-        result= self.load_json( 'analyzer_stat.json' )
-        if result is None:
-            return
+    # 投稿するメッセージを作る
+    #   戻り値は (text, blocks, markdown_text) のリスト
+    #   2 つめ以降は直前のメッセージへの返信になる
+
+    def build_info( self, result ):
         issue_count= result.get('total_issues',0)
         if issue_count != 0:
             text_title= '🟥 AI Review: %s' % result.get('time','')
@@ -416,19 +980,19 @@ class PostTool:
                 },
             },
         ]
-        self.post_message( self.options.channel, text=text_title+'\n'+text, blocks=blocks )
+        return  [ (text_title+'\n'+text, blocks, None) ]
 
-    def post_1( self, log_file_name ):
+    def build_messages( self, log_file_name ):
         analyzed_obj= TextLoader.TextLoader().load( log_file_name )
         default_obj= analyzed_obj.get( 'default', None )
         if default_obj is None:
-            return
+            return  []
         file_name_full= default_obj.get( 'file_name', '' )
         base_file_name= os.path.basename(file_name_full)
         issue_count= default_obj.get( 'issue_count', 0 )
         if issue_count == 0:
             print( 'skip: %s' % file_name_full )
-            return
+            return  []
 
         user_menthon= ''
         user_list= default_obj.get( 'users', [] )
@@ -467,7 +1031,7 @@ class PostTool:
                 },
             },
         ]
-        response= self.post_message( self.options.channel, text=text, blocks=blocks )
+        message_list= [ (text, blocks, None) ]
 
         for issue_id in range(1,issue_count+1):
             obj= {}
@@ -485,24 +1049,88 @@ class PostTool:
                 text+= '更新日: %s\n\n' % date
             text+= '## 内容\n\n'
             text+= description + '\n\n　\n'
-            response= self.post_message( self.options.channel, text=text, blocks=[{'type':'markdown','text':text}], markdown_text=None, parent_response=response )
+            message_list.append( (text, [{'type':'markdown','text':text}], None) )
 
         text= '# 🔵 %s\n\n' % file_name
         text+= '%s\n\n' % default_obj.get('response','')
-        response= self.post_message( self.options.channel, text=text, blocks=[{'type':'markdown','text':text}], markdown_text=None, parent_response=response )
+        message_list.append( (text, [{'type':'markdown','text':text}], None) )
+        return  message_list
+
+    #--------------------------------------------------------------------------
+    # 進捗
+    #   log_dir/.post_progress.json に key ごとの送信済み数と最後の ts を記録する
+    #   途中で止まっても再実行時に続きから送る。すべて送れたら削除する
+
+    def get_progress_file( self ):
+        return  os.path.join( self.options.log_dir, self.PROGRESS_FILE )
+
+    def load_progress( self, run_id ):
+        progress= self.load_json( self.get_progress_file() )
+        if progress is None or progress.get( 'run_id' ) != run_id:
+            progress= { 'run_id': run_id, 'files': {} }
+        return  progress
+
+    def save_progress_0( self ):
+        progress_file= self.get_progress_file()
+        tmp_file= progress_file + '.tmp'
+        with open( tmp_file, 'w', encoding='utf-8' ) as fo:
+            fo.write( json.dumps( self.progress, indent=4, ensure_ascii=False ) )
+        os.replace( tmp_file, progress_file )
+
+    #--------------------------------------------------------------------------
+
+    # 1 つのスレッドは順番に送る
+    def send_messages( self, key, message_list ):
+        with self.lock:
+            state= self.progress['files'].get( key, { 'sent': 0, 'ts': None } )
+        sent= state['sent']
+        if sent >= len(message_list):
+            return  True
+        response= None
+        if state['ts']:
+            response= { 'ts': state['ts'] }
+        for text,blocks,markdown_text in message_list[sent:]:
+            response= self.post_message( self.options.channel, text=text, blocks=blocks, markdown_text=markdown_text, parent_response=response )
+            if response is None:
+                print( 'post error: %s (%d/%d)' % (key, sent, len(message_list)), flush=True )
+                return  False
+            sent+= 1
+            with self.lock:
+                self.progress['files'][key]= { 'sent': sent, 'ts': response.get( 'ts' ) }
+                self.save_progress_0()
+        return  True
+
+    def post_1( self, log_file_name ):
+        message_list= self.build_messages( log_file_name )
+        return  self.send_messages( os.path.basename( log_file_name ), message_list )
 
     def post_all( self ):
-        if os.path.exists( self.options.log_dir ):
-            self.post_info()
-            with os.scandir( self.options.log_dir ) as di:
-                for entry in di:
-                    if entry.name.startswith( '.' ) or not entry.is_file():
-                        continue
-                    _,ext= os.path.splitext( entry.name )
-                    if ext == '.txt':
-                        full_path= os.path.join( self.options.log_dir, entry.name )
-                        self.post_1( full_path )
-            self.api.save_cache()
+        if not os.path.exists( self.options.log_dir ):
+            return
+        result= self.load_json( 'analyzer_stat.json' )
+        run_id= result.get( 'time', '' ) if result else ''
+        self.progress= self.load_progress( run_id )
+        if self.options.use_mention and self.alias is None:
+            self.alias= self.load_json( self.options.alias_file )
+        success= True
+        if result:
+            success= self.send_messages( self.INFO_KEY, self.build_info( result ) )
+        log_list= []
+        with os.scandir( self.options.log_dir ) as di:
+            for entry in di:
+                if entry.name.startswith( '.' ) or not entry.is_file():
+                    continue
+                _,ext= os.path.splitext( entry.name )
+                if ext == '.txt':
+                    log_list.append( os.path.join( self.options.log_dir, entry.name ) )
+        log_list.sort()
+        # ファイルの読み込みと送信はファイル単位で並列に行う
+        with concurrent.futures.ThreadPoolExecutor( max_workers=max( 1, self.options.post_jobs ) ) as executor:
+            for result in executor.map( self.post_1, log_list ):
+                success= success and result
+        self.api.save_cache()
+        if success and os.path.exists( self.get_progress_file() ):
+            os.remove( self.get_progress_file() )
 
 
 #------------------------------------------------------------------------------
@@ -521,12 +1149,22 @@ def usage():
     print( '  --config <config.txt>       default config.txt' )
     print( '  --user_alias <alias_json>   default None' )
     print( '  --limit <max_sources>       default 0' )
+    print( '  --jobs <n>                  default 1' )
+    print( '  --changed_only' )
+    print( '  --resume' )
+    print( '  --retry <n>                 default 2' )
+    print( '  --max_failures <n>          default 5' )
+    print( '  --batch_lines <n>           default 0' )
+    print( '  --order <recent,size,issues>' )
+    print( '  --time_limit <minutes>      default 0' )
+    print( '  --host <url>[,<url>..]' )
     print( '  --use_mention' )
     print( '  --save_list' )
     print( '  --load_list' )
     print( '  --clear' )
     print( '  --analyze' )
     print( '  --post <channel>' )
+    print( '  --post_jobs <n>             default 4' )
     print( '  --nossl' )
     print( '  --debug' )
     print( 'ex. CodeAnalyzer.py --root PROJECT_ROOT --analyze' )
@@ -571,9 +1209,13 @@ def main( argv ):
                 ai= options.set_str( ai, argv, 'model' )
             elif arg == '--limit':
                 ai= options.set_int( ai, argv, 'limit' )
+            elif arg == '--jobs':
+                ai= options.set_int( ai, argv, 'jobs' )
             elif arg == '--post':
                 ai= options.set_str( ai, argv, 'channel' )
                 func_list.append( 'f_post' )
+            elif arg == '--post_jobs':
+                ai= options.set_int( ai, argv, 'post_jobs' )
             elif arg == '--clear_logdir' or arg == '--clear':
                 func_list.append( 'f_clear_logdir' )
             elif arg == '--save_list':
@@ -584,6 +1226,20 @@ def main( argv ):
                 func_list.append( 'f_analyze' )
             elif arg == '--nossl':
                 options.nossl= True
+            elif arg == '--changed_only':
+                options.changed_only= True
+            elif arg == '--resume':
+                options.resume= True
+            elif arg == '--retry':
+                ai= options.set_int( ai, argv, 'retry' )
+            elif arg == '--max_failures':
+                ai= options.set_int( ai, argv, 'max_failures' )
+            elif arg == '--batch_lines':
+                ai= options.set_int( ai, argv, 'batch_lines' )
+            elif arg == '--order':
+                ai= options.set_str( ai, argv, 'order' )
+            elif arg == '--time_limit':
+                ai= options.set_int( ai, argv, 'time_limit' )
             elif arg == '--use_mention':
                 options.use_mention= True
             elif arg == '--debug' or arg == '--print':
@@ -6,6 +6,7 @@ import os
 import json
 import time
 import datetime
+import threading
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
@@ -134,8 +135,93 @@ def load_json( file_name ):
 
 #------------------------------------------------------------------------------
 
+# base_url 毎に requests.Session を保持して接続を再利用する
+class HttpTransport:
+    def __init__( self ):
+        self.lock= threading.Lock()
+        self.session_map= {}    # base_url to [session, last_used, active_count]
+
+    def create_session( self, options ):
+        import requests
+        from requests.adapters import HTTPAdapter
+        session= requests.Session()
+        adapter= HTTPAdapter( pool_connections=1, pool_maxsize=max( 1, options.http_pool_size ) )
+        session.mount( 'http://', adapter )
+        session.mount( 'https://', adapter )
+        return  session
+
+    def evict_idle_0( self, now, idle_timeout ):
+        if idle_timeout <= 0:
+            return
+        for base_url in list(self.session_map.keys()):
+            session,last_used,active_count= self.session_map[base_url]
+            if active_count == 0 and now - last_used > idle_timeout:
+                del self.session_map[base_url]
+                session.close()
+
+    def acquire( self, base_url, options ):
+        now= time.monotonic()
+        with self.lock:
+            self.evict_idle_0( now, options.http_idle_timeout )
+            entry= self.session_map.get( base_url )
+            if entry is None:
+                entry= [ self.create_session( options ), now, 0 ]
+                self.session_map[base_url]= entry
+            entry[1]= now
+            entry[2]+= 1
+            return  entry[0]
+
+    def release( self, base_url ):
+        with self.lock:
+            entry= self.session_map.get( base_url )
+            if entry:
+                entry[1]= time.monotonic()
+                entry[2]-= 1
+
+    # stream=True の場合は本文を読み終わるまで session を返却しない
+    #   呼び出し側は読み終わったら close_response() を呼ぶ
+    def post( self, base_url, api_url, options, **args ):
+        if not options.http_keep_alive:
+            import requests
+            return  requests.post( api_url, **args )
+        session= self.acquire( base_url, options )
+        try:
+            result= session.post( api_url, **args )
+        except:
+            self.release( base_url )
+            raise
+        if args.get( 'stream' ):
+            result.transport_base_url= base_url
+        else:
+            self.release( base_url )
+        return  result
+
+    def close_response( self, result ):
+        if result is None:
+            return
+        base_url= getattr( result, 'transport_base_url', None )
+        if base_url is None:
+            return
+        result.transport_base_url= None
+        result.close()
+        self.release( base_url )
+
+    def close( self ):
+        with self.lock:
+            for session,_,_ in self.session_map.values():
+                session.close()
+            self.session_map.clear()
+
+http_transport= HttpTransport()
+
+def get_transport():
+    return  http_transport
+
+#------------------------------------------------------------------------------
+
 class Session:
     REASONING_TAGS= [ 'reasoning', 'reasoning_content', 'thinking' ]
+    JOURNAL_COMPACT_RECORDS= 64
 
     def __init__( self, session_id= None, options=None ):
         self.session_id= session_id
@@ -146,6 +232,13 @@ class Session:
         self.toolbox= Functions.get_toolbox()
         self.tool_env= Functions.ToolEnv()
         self.lock= None
+        self.fixed_count= 0         # fix_messages で変換済みのメッセージ数
+        self.fixed_format= None
+        self.saved_count= 0         # 保存済みのメッセージ数
+        self.changed_index= 0       # 保存後に書き換えたメッセージの先頭
+        self.saved_system= None
+        self.journal_records= 0
+        self.message_bytes= 0       # メッセージの概算サイズ
 
     def is_root( self ):
         return  self.message_list == []
@@ -159,6 +252,9 @@ class Session:
     def get_lock( self ):
         return  self.lock
 
+    def get_size( self ):
+        return  self.message_bytes
+
     #--------------------------------------------------------------------------
 
     def get_options( self ):
@@ -190,8 +286,15 @@ class Session:
     def set_system( self, text ):
         self.system= { 'role': 'system', 'content': text }
 
+    def get_message_size( self, message ):
+        return  len( json.dumps( message, ensure_ascii=False ) )
+
+    def append_message( self, message ):
+        self.message_list.append( message )
+        self.message_bytes+= self.get_message_size( message )
+
     def push_user( self, text ):
-        self.message_list.append( { 'role': 'user', 'content': text } )
+        self.append_message( { 'role': 'user', 'content': text } )
 
     def push_assistant( self, text, tool_calls, reasoning, reasoning_tag= None ):
         message= { 'role': 'assistant' }
@@ -201,7 +304,7 @@ class Session:
             message['content']= text
         if tool_calls is not None:
             message['tool_calls']= tool_calls
-        self.message_list.append( message )
+        self.append_message( message )
 
     def push_result( self, text, name, tool_id ):
         message= {
@@ -210,7 +313,7 @@ class Session:
                 'tool_call_id': tool_id,
                 'content': text,
               }
-        self.message_list.append( message )
+        self.append_message( message )
 
     def get_messages( self ):
         message_list= []
@@ -221,61 +324,103 @@ class Session:
 
     #--------------------------------------------------------------------------
 
+    # 書き換えた場合は True を返す
+    def fix_message_0( self, message, to_dict, reasoning_tag ):
+        changed= False
+        if 'tool_calls' in message:
+            tool_calls= message['tool_calls']
+            for tool_call in tool_calls:
+                if 'type' not in tool_call:
+                    tool_call['type']= 'function'
+                    changed= True
+                    if self.options.debug_echo:
+                        print( '  $$ INSERT FUNCTION-TYPE $$' )
+                func= tool_call['function']
+                arg= func['arguments']
+                if to_dict:
+                    if type(arg) is str:
+                        func['arguments']= json.loads( arg )
+                        changed= True
+                        if self.options.debug_echo:
+                            print( '  $$ CONVERT ARG to Dict $$' )
+                else:
+                    if type(arg) is dict:
+                        func['arguments']= json.dumps( arg )
+                        changed= True
+                        if self.options.debug_echo:
+                            print( '  $$ CONVERT ARG to Json $$' )
+        if 'content' not in message:
+            message['content']= '\n\n'
+            changed= True
+        for tag in self.REASONING_TAGS:
+            if tag in message:
+                if tag != reasoning_tag:
+                    message[reasoning_tag]= message[tag]
+                    del message[tag]
+                    changed= True
+                    if self.options.debug_echo:
+                        print( '  $$ CONVERT TAG %s to %s $$' % (tag, reasoning_tag) )
+        return  changed
+
+    # fixed_count より前のメッセージは同じ形式で変換済みなので、追加分だけ変換する
+    # 形式 (provider) が変わった場合は全体を変換し直す
     def fix_messages( self, to_dict, reasoning_tag ):
+        fixed_format= (to_dict, reasoning_tag)
+        start= 0
+        if self.fixed_format == fixed_format and self.fixed_count <= len(self.message_list):
+            start= self.fixed_count
         prev_message= None
         prev_role= None
-        for message in self.message_list:
+        prev_index= start
+        if start > 0:
+            prev_index= start-1
+            prev_message= self.message_list[prev_index]
+            prev_role= prev_message['role']
+        changed_index= len(self.message_list)
+        deleted= False
+        for index,message in enumerate(self.message_list[start:],start):
             role= message['role']
             if role == 'assistant':
-                if 'tool_calls' in message:
-                    tool_calls= message['tool_calls']
-                    for tool_call in tool_calls:
-                        if 'type' not in tool_call:
-                            tool_call['type']= 'function'
-                            if self.options.debug_echo:
-                                print( '  $$ INSERT FUNCTION-TYPE $$' )
-                        func= tool_call['function']
-                        arg= func['arguments']
-                        if to_dict:
-                            if type(arg) is str:
-                                func['arguments']= json.loads( arg )
-                                if self.options.debug_echo:
-                                    print( '  $$ CONVERT ARG to Dict $$' )
-                        else:
-                            if type(arg) is dict:
-                                func['arguments']= json.dumps( arg )
-                                if self.options.debug_echo:
-                                    print( '  $$ CONVERT ARG to Json $$' )
-                if 'content' not in message:
-                    message['content']= '\n\n'
-                for tag in self.REASONING_TAGS:
-                    if tag in message:
-                        if tag != reasoning_tag:
-                            message[reasoning_tag]= message[tag]
-                            del message[tag]
-                            if self.options.debug_echo:
-                                print( '  $$ CONVERT TAG %s to %s $$' % (tag, reasoning_tag) )
+                if self.fix_message_0( message, to_dict, reasoning_tag ):
+                    changed_index= min( changed_index, index )
             elif role == 'user':
                 if prev_role == 'user':
                     prev_message['content']+= '\n' + message['content']
                     message['content']= ''
                     message['role']= None
+                    changed_index= min( changed_index, prev_index )
+                    deleted= True
                     if self.options.debug_echo:
                         print( '  $$ MERGE USER MESSAGE $$' )
                     continue
             prev_role= role
             prev_message= message
-        fixed_message_list= []
-        for message in self.message_list:
-            if message['role'] is not None:
-                fixed_message_list.append( message )
-            else:
-                if self.options.debug_echo:
-                    print( '  $$ DELETE MESSAGE $$' )
-        self.message_list= fixed_message_list
+            prev_index= index
+        if deleted:
+            fixed_message_list= self.message_list[:start]
+            for message in self.message_list[start:]:
+                if message['role'] is not None:
+                    fixed_message_list.append( message )
+                else:
+                    if self.options.debug_echo:
+                        print( '  $$ DELETE MESSAGE $$' )
+            self.message_list= fixed_message_list
+        self.fixed_count= len(self.message_list)
+        self.fixed_format= fixed_format
+        self.changed_index= min( self.changed_index, changed_index )
 
     #--------------------------------------------------------------------------
 
+    # 保存形式
+    #   <session>.json   snapshot (従来形式そのまま。既存の threads/*.json もそのまま読める)
+    #   <session>.jsonl  snapshot 以降の追記ログ。1 行 1 レコード
+    #       { "base": N, "messages": [...], "msg_info": {..}, "tool_env": {..} }
+    #       message_list[:N] に messages を連結したものが新しい message_list
+    # 追記が JOURNAL_COMPACT_RECORDS 回を超えたら snapshot を作り直して追記ログを消す
+
+    def get_journal_filename( self, file_name ):
+        return  os.path.splitext( file_name )[0] + '.jsonl'
+
     def save_session( self, file_name ):
         save_json( file_name, {
                     'session_id': self.session_id,
@@ -285,6 +430,50 @@ class Session:
                     'msg_info': self.msg_info,
                     'tool_env': self.tool_env.to_dict(),
                 } )
+        journal_name= self.get_journal_filename( file_name )
+        if os.path.exists( journal_name ):
+            os.remove( journal_name )
+        self.journal_records= 0
+        self.saved_count= len(self.message_list)
+        self.changed_index= self.saved_count
+        self.saved_system= self.system
+
+    def append_session( self, file_name ):
+        if self.journal_records >= self.JOURNAL_COMPACT_RECORDS or not os.path.exists( file_name ):
+            self.save_session( file_name )
+            return
+        base= min( self.saved_count, self.changed_index, len(self.message_list) )
+        record= {
+                'base': base,
+                'messages': self.message_list[base:],
+                'msg_info': self.msg_info,
+                'tool_env': self.tool_env.to_dict(),
+            }
+        if self.system != self.saved_system:
+            record['system']= self.system
+        with open( self.get_journal_filename( file_name ), 'a', encoding='utf-8' ) as fo:
+            fo.write( json.dumps( record, ensure_ascii=False ) + '\n' )
+        self.journal_records+= 1
+        self.saved_count= len(self.message_list)
+        self.changed_index= self.saved_count
+        self.saved_system= self.system
+
+    def load_journal( self, journal_name ):
+        with open( journal_name, 'r', encoding='utf-8', errors='ignore' ) as fi:
+            for line in fi:
+                try:
+                    record= json.loads( line )
+                except ValueError:
+                    # 書き込み途中で終わった行。次の保存で snapshot を作り直す
+                    self.journal_records= self.JOURNAL_COMPACT_RECORDS
+                    break
+                base= record.get('base',0)
+                self.message_list= self.message_list[:base] + record.get('messages',[])
+                self.msg_info= record.get('msg_info',self.msg_info)
+                self.tool_env= Functions.ToolEnv( record.get('tool_env',{}) )
+                if 'system' in record:
+                    self.system= record['system']
+                self.journal_records+= 1
 
     def load_session( self, file_name ):
         obj= load_json( file_name )
@@ -295,6 +484,16 @@ class Session:
             self.options= None
             self.msg_info= obj.get('msg_info',{})
             self.tool_env= Functions.ToolEnv( obj.get('tool_env',{}) )
+            self.fixed_count= 0
+            self.fixed_format= None
+            self.journal_records= 0
+            journal_name= self.get_journal_filename( file_name )
+            if os.path.exists( journal_name ):
+                self.load_journal( journal_name )
+            self.saved_count= len(self.message_list)
+            self.changed_index= self.saved_count
+            self.saved_system= self.system
+            self.message_bytes= sum( self.get_message_size( message ) for message in self.message_list )
 
 #------------------------------------------------------------------------------
 
@@ -320,6 +519,10 @@ class CommonOptions(OptionBase):
         self.response_all= False
         self.debug_echo= False
         self.verify= True
+        self.http_keep_alive= True
+        self.http_pool_size= 8
+        self.http_idle_timeout= 60.0
+        self.tool_workers= 4        # 1 回の応答内の tool call を並列実行するスレッド数
         self.tools= []
         self.tool_info_list= []
         #self.tool_env= os.environ
@@ -331,6 +534,7 @@ class CommonAPI:
     def __init__( self, options ):
         self.options= options
         self.api_map= {}
+        self.transport= get_transport()
         self.stat_reset()
         if self.options.debug_echo:
             Functions.get_toolbox().debug_echo= True
@@ -400,11 +604,12 @@ class CommonAPI:
             return  api.chat( text, system, image_data, message_list, options )
         return  'Unknown provider: %s' % provider,400
 
-    def generate2( self, session ):
+    # callback( text ) には生成途中のテキストが逐次渡される
+    def generate2( self, session, callback= None ):
         options= session.get_options()
         api= self.load_api( options.provider, options )
         if api:
-            return  api.chat2( session )
+            return  api.chat2( session, callback )
         return  'Unknown provider: %s' % provider,400
 
     #--------------------------------------------------------------------------
@@ -38,10 +38,16 @@ class ChatCLI:
         thread_id+= '_%06d' % ((int)(f * 1000000))
         return  thread_id
 
+    def print_stream( self, text ):
+        print( text, end='', flush=True )
+
     def bot_single( self, thread_id, prompt ):
         if prompt.strip() != '':
             prompt= 'USER: ' + prompt
-            result= self.bot.bot( thread_id, prompt, '', {} )
+            callback= None
+            if self.options.streaming:
+                callback= self.print_stream
+            result= self.bot.bot( thread_id, prompt, '', {}, callback )
             print( '\n\U0001f916 ****************' )
             print( result )
             print( '*******************', flush=True )
@@ -71,6 +77,7 @@ def usage():
     print( '  --provider <provider>' )
     print( '  --model <model>' )
     print( '  --load <thread_id>' )
+    print( '  --stream' )
     print( '  --print' )
     print( '  --debug' )
     sys.exit( 1 )
@@ -99,6 +106,8 @@ def main( argv ):
                 ai= options.set_str( ai, argv, 'model' )
             elif arg == '--load':
                 ai= options.set_str( ai, argv, 'load_session' )
+            elif arg == '--stream':
+                options.streaming= True
             elif arg == '--noverify':
                 options.verify= False
             elif arg == '--print':
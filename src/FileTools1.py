@@ -9,6 +9,7 @@ lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
     sys.path.append( lib_path )
 from Functions import get_toolbox,ToolEnv
+import SourceIndex
 
 #------------------------------------------------------------------------------
 
@@ -170,31 +171,28 @@ def read_source_code4( env:ToolEnv, file_name:str ) -> str:
 
 #------------------------------------------------------------------------------
 
-def grep_files( folder, pat_key, filename, content ):
+def grep_files( folder, searcher, filename, content ):
     result_text= '**Found documents**:\n\n'
     found_files= 0
     root_length= len(folder)+1
+    path_list= []
     for root,dirs,files in os.walk( folder ):
         if '.git' in root:
             continue
         if '__pycache__' in root:
             continue
         for name in files:
-            full_path= os.path.join( root, name )
-            relative_path= full_path[root_length:]
-            if filename:
-                pat= pat_key.search( relative_path )
-                if pat:
-                    result_text+= '- %s\n' % relative_path
-                    found_files+= 1
-                    continue
-            if content:
-                with open( full_path, 'r', encoding='utf-8', errors='ignore' ) as fi:
-                    data= fi.read()
-                    pat= pat_key.search( data )
-                    if pat:
-                        result_text+= '- %s\n' % relative_path
-                        found_files+= 1
+            path_list.append( os.path.join( root, name ) )
+    def match_1( full_path ):
+        if filename and searcher.pat.search( full_path[root_length:] ):
+            return  True
+        if content:
+            return  searcher.match_file( full_path )
+        return  False
+    for full_path,found in SourceIndex.map_files( match_1, path_list ):
+        if found:
+            result_text+= '- %s\n' % full_path[root_length:]
+            found_files+= 1
     if found_files == 0:
         result_text= 'File not found\n\n'
     return  result_text
@@ -214,11 +212,11 @@ def search_in_files( env:ToolEnv, pattern:str, case_sensitive:bool=True, include
     if not case_sensitive:
         flags|= re.IGNORECASE
     try:
-        pat_key= re.compile( pattern, flags )
+        searcher= SourceIndex.TextSearcher( pattern, flags )
     except re.error as e:
         return  str(e)
     folder_root= env.get( 'MCP_FOLDER_ROOT', env.get( 'MCP_SOURCE_ROOT', '' ) )
-    return  grep_files( folder_root, pat_key, include_filenames, True )
+    return  grep_files( folder_root, searcher, include_filenames, True )
 
 #------------------------------------------------------------------------------
 
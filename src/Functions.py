@@ -4,6 +4,7 @@
 import os
 import inspect
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 #------------------------------------------------------------------------------
 
@@ -29,6 +30,7 @@ class ToolBox:
     def __init__( self ):
         self.info_list= []
         self.func_map= {}
+        self.serial_set= set()      # 並列実行しない function
         self.debug_echo= False
 
     def get_function_info( self, func ):
@@ -70,18 +72,23 @@ class ToolBox:
             func_info['parameters']['required']= required
         return  { 'type': 'function', 'function': func_info },with_env
 
-    def add( self, func ):
+    def add( self, func, serial= False ):
         func_info,with_env= self.get_function_info( func )
         self.func_map[func.__name__]= func_info,with_env,func
+        if serial:
+            self.serial_set.add( func.__name__ )
+        else:
+            self.serial_set.discard( func.__name__ )
         if self.debug_echo:
             #print( 'Load: Function "%s"' % func.__name__, func.__doc__ )
             print( 'Load: Function "%s"' % func.__name__ )
         return  func
 
-    def tool( self, func= None ):
+    # serial=True の tool は他の tool と同時に実行しない
+    def tool( self, func= None, serial= False ):
         if func is None:
-            return  self.add
-        return  self.add( func )
+            return  lambda func: self.add( func, serial )
+        return  self.add( func, serial )
 
     def select_tools( self, name_list ):
         self.info_list= self.get_tools( name_list )
@@ -116,6 +123,37 @@ class ToolBox:
                 print( 'Call: %s(%s) result=%d chars' % (func_name,str(args),len(result)), flush=True )
         return  result
 
+    # 例外はその tool の結果としてエラー文字列にし、他の tool の結果を失わないようにする
+    def call_func_1( self, func_name, args, env= None ):
+        try:
+            return  self.call_func( func_name, args, env )
+        except Exception as e:
+            print( 'Call: %s error=%s' % (func_name,str(e)), flush=True )
+            return  'Error in tool call "%s". %s' % (func_name,str(e))
+
+    # 1 回の応答に含まれる複数の tool call を実行する
+    # call_list= [ (func_name, args), .. ]  結果は call_list と同じ順番で返す
+    # serial な tool は前後の呼び出しが終わってから単独で実行する
+    def call_func_list( self, call_list, env= None, max_workers= 1 ):
+        result_list= [None] * len(call_list)
+        if max_workers <= 1 or len(call_list) <= 1:
+            for index,(func_name,args) in enumerate(call_list):
+                result_list[index]= self.call_func_1( func_name, args, env )
+            return  result_list
+        with ThreadPoolExecutor( max_workers=min( max_workers, len(call_list) ) ) as executor:
+            future_list= []
+            for index,(func_name,args) in enumerate(call_list):
+                if func_name in self.serial_set:
+                    for future_index,future in future_list:
+                        result_list[future_index]= future.result()
+                    future_list= []
+                    result_list[index]= self.call_func_1( func_name, args, env )
+                else:
+                    future_list.append( (index, executor.submit( self.call_func_1, func_name, args, env )) )
+            for future_index,future in future_list:
+                result_list[future_index]= future.result()
+        return  result_list
+
 mcp= ToolBox()
 
 def get_toolbox():
@@ -34,7 +34,7 @@ class LocalMemory:
 
 local_memory= LocalMemory()
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def add_note( title:str, content:str ) -> str:
     """
     Adds a note with the given title and content to retain critical information.
@@ -49,7 +49,7 @@ def add_note( title:str, content:str ) -> str:
     note_id= local_memory.append( title, content )
     return  'Added: ntoe_id=%d' % note_id
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def get_note( ntoe_id:int ) -> str:
     """
     Retrieves a note by its unique ID.
@@ -61,7 +61,7 @@ def get_note( ntoe_id:int ) -> str:
     _,title,content= local_memory.get_memory( note_id )
     return  '# ' + title + '\n\n' + content + '\n'
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def get_note_list() -> str:
     """
     Returns a list of note entries with their ids and titles.
@@ -73,7 +73,7 @@ def get_note_list() -> str:
             result+= '- %d : %s\n' % (note[0],note[1])
     return  result
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def delete_note( note_id:int ) -> str:
     """
     Deletes a note by its id.
@@ -5,7 +5,6 @@ import sys
 import os
 import re
 import json
-import requests
 import base64
 import time
 import datetime
@@ -30,28 +29,42 @@ class OllamaAPI:
 
     #--------------------------------------------------------------------------
 
-    def decode_streaming( self, result ):
+    # NDJSON を 1 行ずつ受信しながら結合する
+    #   1 行も受信できなかった場合は None
+    def decode_streaming( self, result, callback= None ):
         content= ''
         thinking= ''
         tools= []
-        for line in result.text.split( '\n' ):
+        data= None
+        message= { 'role': 'assistant', 'content': '' }
+        for line in result.iter_lines():
+            if not line:
+                continue
             data= json.loads( line )
-            message= data['message']
-            role= message['role']
-            content+= message['content']
+            if 'error' in data:
+                return  { 'message': { 'role': 'assistant', 'content': str(data['error']) } }
+            message= data.get( 'message', message )
+            text= message.get( 'content', '' )
+            if text:
+                content+= text
+                if callback:
+                    callback( text )
             if 'thinking' in message:
                 thinking+= message['thinking']
             if 'tool_calls' in message:
                 tools.extend( message['tool_calls'] )
-            if data['done']:
+            if data.get( 'done' ):
                 break
+        if data is None:
+            return  None
         message['content']= content
         if thinking != '':
             message['thinking']= thinking
-        if message['role'] == '':
+        if message.get('role','') == '':
             message['role']= 'assistant'
         if tools != []:
             message['tool_calls']= tools
+        data['message']= message
         return  data
 
     #--------------------------------------------------------------------------
@@ -91,18 +104,28 @@ class OllamaAPI:
         }
         try:
             start_time= time.perf_counter()
-            result= requests.post( api_url, headers=headers, data=data, timeout=options.timeout, verify=options.verify )
-            request_time= time.perf_counter() - start_time
+            result= self.manager.transport.post( options.base_url, api_url, options, headers=headers, data=data, timeout=options.timeout, verify=options.verify, stream=streaming )
+            try:
+                response_data= None
+                if result.status_code == 200:
+                    if streaming:
+                        response_data= self.decode_streaming( result )
+                    else:
+                        response_data= result.json()
+                request_time= time.perf_counter() - start_time
+            finally:
+                self.manager.transport.close_response( result )
         except Exception as e:
             print( 'err-url:',api_url )
             print( 'err-datasize:',len(data) )
             print( str(e), flush=True )
             return  None,408
+        if result.status_code == 200 and response_data is None:
+            print( 'err-url:',api_url )
+            print( 'Error: empty streaming response', flush=True )
+            return  None,502
         if result.status_code == 200:
-            if streaming:
-                data= self.decode_streaming( result )
-            else:
-                data= result.json()
+            data= response_data
             if options.debug_echo:
                 self.manager.dump_response( data )
             self.manager.stat_add( data.get('eval_count',0), data.get('prompt_eval_count',0), request_time )
@@ -173,7 +196,7 @@ class OllamaAPI:
 
     #--------------------------------------------------------------------------
 
-    def chat2_1( self, session ):
+    def chat2_1( self, session, callback= None ):
         message_list= session.get_messages()
         options= session.get_options()
         if options.debug_echo:
@@ -216,22 +239,35 @@ class OllamaAPI:
         }
         try:
             start_time= time.perf_counter()
-            result= requests.post( api_url, headers=headers, data=data, timeout=options.timeout, verify=options.verify )
-            request_time= time.perf_counter() - start_time
+            result= self.manager.transport.post( options.base_url, api_url, options, headers=headers, data=data, timeout=options.timeout, verify=options.verify, stream=options.streaming )
+            try:
+                response_data= None
+                if result.status_code == 200:
+                    if options.streaming:
+                        response_data= self.decode_streaming( result, callback )
+                    else:
+                        response_data= result.json()
+                request_time= time.perf_counter() - start_time
+            finally:
+                self.manager.transport.close_response( result )
         except Exception as e:
             print( 'err-url:',api_url )
             print( 'err-datasize:',len(data) )
             print( str(e), flush=True )
             return  None,408
+        if result.status_code == 200 and response_data is None:
+            print( 'err-url:',api_url )
+            print( 'Error: empty streaming response', flush=True )
+            return  None,502
         if result.status_code == 200:
-            if options.streaming:
-                data= self.decode_streaming( result )
-            else:
-                data= result.json()
+            data= response_data
             if options.debug_echo:
                 self.manager.dump_response( data )
             self.manager.stat_add( data.get('eval_count',0), data.get('prompt_eval_count',0), request_time )
             message= data['message']
+            if callback and not options.streaming:
+                if message.get('content'):
+                    callback( message['content'] )
             return  message,result.status_code
         else:
             print( 'err-url:',api_url )
@@ -239,7 +275,7 @@ class OllamaAPI:
             print( 'Error: %d' % result.status_code, flush=True )
         return  None,result.status_code
 
-    def chat2( self, session ):
+    def chat2( self, session, callback= None ):
         options= session.get_options()
         toolbox= session.get_toolbox()
         session.fix_messages( True, 'thinking' ) # json to dict
@@ -247,7 +283,7 @@ class OllamaAPI:
         content= ''
         status_code= 408
         while True:
-            message,status_code= self.chat2_1( session )
+            message,status_code= self.chat2_1( session, callback )
             if status_code != 200:
                 return  response,status_code
             role= message['role']
@@ -259,21 +295,29 @@ class OllamaAPI:
             session.push_assistant( content, tool_calls, reasoning, 'thinking' )
             if content and content.strip() != '':
                 response+= content + '\n'
+                if callback:
+                    callback( '\n' )
             if tool_calls:
                 toolresult= False
+                call_list= []
                 for tool_call in tool_calls:
-                    tool_call_id= tool_call['id']
                     function= tool_call['function']
                     func_name= function['name']
                     arguments= function['arguments']
-                    data= ''
                     if toolbox:
                         print( '**TOOLCALL**:', func_name, arguments, flush=True )
-                        data= toolbox.call_func( func_name, arguments, session.get_tool_env() )
+                    call_list.append( (func_name, arguments) )
+                result_list= [ '' ] * len(call_list)
+                if toolbox:
+                    result_list= toolbox.call_func_list( call_list, session.get_tool_env(), options.tool_workers )
+                for tool_call,(func_name,_),data in zip( tool_calls, call_list, result_list ):
+                    tool_call_id= tool_call['id']
                     session.push_result( data, func_name, tool_call_id )
                     toolresult= True
                     if options.response_all:
                         response+= '\U0001f527 toolcall: %s\n' % func_name
+                        if callback:
+                            callback( '\U0001f527 toolcall: %s\n' % func_name )
                 if toolresult:
                     continue
             break
@@ -298,7 +342,7 @@ class OllamaAPI:
         api_url= self.options.base_url + '/api/generate'
         data= json.dumps( params )
         try:
-            result= requests.post( api_url, headers={ 'Content-Type': 'application/json' }, data=data, timeout=self.options.timeout, verify=self.options.verify )
+            result= self.manager.transport.post( self.options.base_url, api_url, self.options, headers={ 'Content-Type': 'application/json' }, data=data, timeout=self.options.timeout, verify=self.options.verify )
         except Exception as e:
             return  '',408
         if result.status_code == 200:
@@ -3,7 +3,6 @@
 
 import os
 import json
-import requests
 import base64
 import time
 
@@ -25,6 +24,64 @@ class OpenAIAPI:
 
     #--------------------------------------------------------------------------
 
+    # SSE (data: {...}) を受信しながら delta を結合する
+    def decode_streaming( self, result, callback= None ):
+        content= ''
+        reasoning= ''
+        reasoning_tag= 'reasoning_content'
+        tool_calls= []
+        usage= None
+        for line in result.iter_lines():
+            if not line:
+                continue
+            line= line.decode( 'utf-8', errors='replace' )
+            if not line.startswith( 'data:' ):
+                continue
+            payload= line[5:].strip()
+            if payload == '[DONE]':
+                break
+            data= json.loads( payload )
+            if 'error' in data:
+                return  data
+            if data.get('usage'):
+                usage= data['usage']
+            choices= data.get('choices')
+            if not choices:
+                continue
+            delta= choices[0].get('delta',{})
+            text= delta.get('content')
+            if text:
+                content+= text
+                if callback:
+                    callback( text )
+            for tag in [ 'reasoning_content', 'reasoning' ]:
+                if delta.get(tag):
+                    reasoning+= delta[tag]
+                    reasoning_tag= tag
+            for tool_delta in delta.get('tool_calls') or []:
+                index= tool_delta.get( 'index', len(tool_calls) )
+                while len(tool_calls) <= index:
+                    tool_calls.append( { 'id': '', 'type': 'function', 'function': { 'name': '', 'arguments': '' } } )
+                tool_call= tool_calls[index]
+                if tool_delta.get('id'):
+                    tool_call['id']= tool_delta['id']
+                function= tool_delta.get('function',{})
+                if function.get('name'):
+                    tool_call['function']['name']+= function['name']
+                if function.get('arguments'):
+                    tool_call['function']['arguments']+= function['arguments']
+        message= { 'role': 'assistant', 'content': content }
+        if reasoning != '':
+            message[reasoning_tag]= reasoning
+        if tool_calls != []:
+            message['tool_calls']= tool_calls
+        data= { 'choices': [ { 'message': message } ] }
+        if usage:
+            data['usage']= usage
+        return  data
+
+    #--------------------------------------------------------------------------
+
     def chat_1( self, message_list, tools, options ):
         if options.debug_echo:
             self.manager.dump_message_list( 'SendMessages', message_list )
@@ -70,7 +127,7 @@ class OpenAIAPI:
         }
         try:
             start_time= time.perf_counter()
-            result= requests.post( api_url, headers=headers, data=data, timeout=options.timeout, verify=options.verify )
+            result= self.manager.transport.post( options.base_url, api_url, options, headers=headers, data=data, timeout=options.timeout, verify=options.verify )
             request_time= time.perf_counter() - start_time
         except Exception as e:
             print( 'err-url:',api_url )
@@ -161,7 +218,7 @@ class OpenAIAPI:
 
     #--------------------------------------------------------------------------
 
-    def chat2_1( self, session ):
+    def chat2_1( self, session, callback= None ):
         message_list= session.get_messages()
         options= session.get_options()
         if options.debug_echo:
@@ -172,6 +229,9 @@ class OpenAIAPI:
         }
         if options.tool_info_list != []:
             params['tools']= options.tool_info_list
+        if options.streaming:
+            params['stream']= True
+            params['stream_options']= { 'include_usage': True }
         data= json.dumps( params )
         if options.temperature >= 0.0:
             params['temperature']= options.temperature
@@ -206,23 +266,34 @@ class OpenAIAPI:
         }
         try:
             start_time= time.perf_counter()
-            result= requests.post( api_url, headers=headers, data=data, timeout=options.timeout, verify=options.verify )
-            request_time= time.perf_counter() - start_time
+            result= self.manager.transport.post( options.base_url, api_url, options, headers=headers, data=data, timeout=options.timeout, verify=options.verify, stream=options.streaming )
+            try:
+                response_data= None
+                if result.status_code == 200:
+                    if options.streaming:
+                        response_data= self.decode_streaming( result, callback )
+                    else:
+                        response_data= result.json()
+                request_time= time.perf_counter() - start_time
+            finally:
+                self.manager.transport.close_response( result )
         except Exception as e:
             print( 'err-url:',api_url )
             print( 'err-datasize:',len(data) )
             print( str(e), flush=True )
             return  '',408
         if result.status_code == 200:
-            data= result.json()
             if options.debug_echo:
-                self.manager.dump_response( data )
-            if 'usage' in data:
-                usage= data['usage']
+                self.manager.dump_response( response_data )
+            if 'usage' in response_data:
+                usage= response_data['usage']
                 self.manager.stat_add( usage.get('completion_tokens',0), usage.get('prompt_tokens',0), request_time )
-            if 'error' in data:
-                return  { 'role': 'assistant', 'content': data['error'] },200
-            message= data['choices'][0]['message']
+            if 'error' in response_data:
+                return  { 'role': 'assistant', 'content': str(response_data['error']) },200
+            message= response_data['choices'][0]['message']
+            if callback and not options.streaming:
+                if message.get('content'):
+                    callback( message['content'] )
             return  message,result.status_code
         else:
             print( 'err-url:',api_url )
@@ -231,7 +302,7 @@ class OpenAIAPI:
             print( 'Error: %d' % result.status_code, flush=True )
         return  None,result.status_code
 
-    def chat2( self, session ):
+    def chat2( self, session, callback= None ):
         options= session.get_options()
         toolbox= session.get_toolbox()
         session.fix_messages( False, 'reasoning' ) # dict to json
@@ -239,7 +310,7 @@ class OpenAIAPI:
         content= ''
         status_code= 408
         while True:
-            message,status_code= self.chat2_1( session )
+            message,status_code= self.chat2_1( session, callback )
             if status_code != 200:
                 return  response,status_code
             role= message['role']
@@ -257,21 +328,29 @@ class OpenAIAPI:
             session.push_assistant( content, tool_calls, reasoning, reasoning_tag )
             if content and content.strip() != '':
                 response+= content + '\n'
+                if callback:
+                    callback( '\n' )
             if tool_calls:
                 toolresult= False
+                call_list= []
                 for tool_call in tool_calls:
-                    tool_call_id= tool_call['id']
                     function= tool_call['function']
                     func_name= function['name']
                     arguments= json.loads(function['arguments'])
-                    data= ''
                     if toolbox:
                         print( '**TOOLCALL**:', func_name, arguments, flush=True )
-                        data= toolbox.call_func( func_name, arguments, session.get_tool_env() )
+                    call_list.append( (func_name, arguments) )
+                result_list= [ '' ] * len(call_list)
+                if toolbox:
+                    result_list= toolbox.call_func_list( call_list, session.get_tool_env(), options.tool_workers )
+                for tool_call,(func_name,_),data in zip( tool_calls, call_list, result_list ):
+                    tool_call_id= tool_call['id']
                     session.push_result( data, func_name, tool_call_id )
                     toolresult= True
                     if options.response_all:
                         response+= '\U0001f527 toolcall: %s\n' % func_name
+                        if callback:
+                            callback( '\U0001f527 toolcall: %s\n' % func_name )
                 if toolresult:
                     continue
             break
@@ -305,7 +384,7 @@ class OpenAIAPI:
             'Authorization': 'Bearer %s' % os.environ.get('OPENAI_API_KEY', 'lm-studio'),
         }
         try:
-            result= requests.post( api_url, headers=headers, data=data, timeout=self.options.timeout, verify=self.options.verify )
+            result= self.manager.transport.post( self.options.base_url, api_url, self.options, headers=headers, data=data, timeout=self.options.timeout, verify=self.options.verify )
         except Exception as e:
             return  '',408
         if result.status_code == 200:
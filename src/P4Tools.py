@@ -105,7 +105,7 @@ def _format_change( c ):
 
 mcp= get_toolbox()
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def p4_recent_changes( path: str, max_count: int, user_filter: str ) -> str:
     """
     List recent submitted changelists for a depot path with full submit messages.
@@ -144,7 +144,7 @@ def p4_recent_changes( path: str, max_count: int, user_filter: str ) -> str:
 
 #------------------------------------------------------------------------------
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def p4_describe_change( changelist: int ) -> str:
     """
     Show full details of a single submitted changelist: submitter, timestamp,
@@ -190,7 +190,7 @@ def p4_describe_change( changelist: int ) -> str:
 
 #------------------------------------------------------------------------------
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def p4_search_changes( path: str, message_pattern: str, scan_count: int ) -> str:
     """
     Scan recent submitted changelists and return only those whose submit message
@@ -234,7 +234,7 @@ def p4_search_changes( path: str, message_pattern: str, scan_count: int ) -> str
 
 #------------------------------------------------------------------------------
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def p4_info() -> str:
     """
     Show the current Perforce connection settings (server, user, client, default path).
@@ -269,7 +269,7 @@ def p4_info() -> str:
 
 #------------------------------------------------------------------------------
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def p4_exec( arguments_json: str ) -> str:
     """
     Executes the p4 command directly. Arbitrary commands may be executed.
@@ -28,7 +28,110 @@ def load_json( file_name ):
 
 #-------------------------------------------------------------------------------
 
+class TokenBucket:
+    def __init__( self, rate, burst ):
+        self.lock= threading.Lock()
+        self.rate= rate             # 1 秒あたりの回数
+        self.burst= burst
+        self.tokens= burst
+        self.last_time= time.monotonic()
+        self.pause_until= 0.0
+
+    # 待つ必要がある秒数を返す。token は先に確保する
+    def reserve( self ):
+        with self.lock:
+            now= time.monotonic()
+            self.tokens= min( self.burst, self.tokens + (now - self.last_time) * self.rate )
+            self.last_time= now
+            self.tokens-= 1
+            wait_time= 0.0
+            if self.tokens < 0:
+                wait_time= -self.tokens / self.rate
+            return  max( wait_time, self.pause_until - now )
+
+    # 429 Retry-After
+    def pause( self, seconds ):
+        with self.lock:
+            now= time.monotonic()
+            self.pause_until= max( self.pause_until, now + seconds )
+            # 再開時点で 1 回分だけ使えるようにする
+            self.tokens= min( self.burst, self.tokens + (now - self.last_time) * self.rate, 1 - seconds * self.rate )
+            self.last_time= now
+
+
+# Slack の Web API Tier ごとの制限
+#   https://api.slack.com/docs/rate-limits
+class RateLimiter:
+    TIER_MAP= {     # tier: (回数/秒, burst)
+        'tier1': ( 1/60, 1 ),
+        'tier2': ( 20/60, 3 ),
+        'tier3': ( 50/60, 5 ),
+        'tier4': ( 100/60, 10 ),
+        'post':  ( 1.0, 3 ),        # chat.postMessage はチャンネルごとに 1 回/秒
+    }
+    METHOD_MAP= {
+        'conversations_list': 'tier2',
+        'users_list': 'tier2',
+        'conversations_history': 'tier3',
+        'conversations_replies': 'tier3',
+        'chat_update': 'tier3',
+        'chat_delete': 'tier3',
+        'reactions_add': 'tier3',
+        'users_info': 'tier4',
+        'chat_postMessage': 'post',
+    }
+
+    def __init__( self ):
+        self.lock= threading.Lock()
+        self.bucket_map= {}
+
+    def get_bucket( self, method, channel= None ):
+        tier= self.METHOD_MAP.get( method, 'tier3' )
+        key= tier
+        if tier == 'post':
+            key= 'post:%s' % channel
+        with self.lock:
+            bucket= self.bucket_map.get( key )
+            if bucket is None:
+                bucket= TokenBucket( *self.TIER_MAP[tier] )
+                self.bucket_map[key]= bucket
+            return  bucket
+
+    def acquire( self, method, channel= None ):
+        wait_time= self.get_bucket( method, channel ).reserve()
+        if wait_time > 0:
+            time.sleep( wait_time )
+
+    def pause( self, method, seconds, channel= None ):
+        self.get_bucket( method, channel ).pause( seconds )
+
+rate_limiter= RateLimiter()
+
+MAX_RETRY= 3
+
+# WebClient の API をレート制限付きで呼び出す。429 なら Retry-After 秒待って再試行
+#   slack_bolt から渡される client でも使える
+def call_api( client, method, **args ):
+    channel= args.get( 'channel' )
+    retry= 0
+    while True:
+        rate_limiter.acquire( method, channel )
+        try:
+            return  getattr( client, method )( **args )
+        except SlackApiError as e:
+            if e.response.status_code != 429 or retry >= MAX_RETRY:
+                raise
+            retry+= 1
+            retry_after= float( e.response.headers.get( 'Retry-After', 1 ) )
+            print( 'Slack rate limited: %s retry after %.1f' % (method, retry_after), flush=True )
+            rate_limiter.pause( method, retry_after, channel )
+
+#-------------------------------------------------------------------------------
+
 class SlackAPI:
+    CHANNEL_TTL= 3600           # チャンネル一覧を取り直す間隔 (秒)
+    CHANNEL_MISS_WINDOW= 60     # 見つからなかった名前で再取得しない期間 (秒)
+
     def __init__( self, token, cache_file=None, nossl=False ):
         self.lock= threading.Lock()
         if nossl:
@@ -41,6 +144,10 @@ class SlackAPI:
             self.client = WebClient( token=token )
         self.user_map= {}       # user_id to user_info
         self.channel_map= {}    # channel_name to channel_id
+        self.channel_id_set= set()
+        self.channel_time= 0    # チャンネル一覧を取得した時刻
+        self.channel_miss_map= {}   # channel_name to 見つからなかった時刻
+        self.refresh_lock= threading.Lock()
         self.all_channels= []
         self.all_users= []
         self.cache_file= 'slack_cache.json'
@@ -50,6 +157,9 @@ class SlackAPI:
         self.load_cache()
         self.update_users_()
 
+    def call( self, method, **args ):
+        return  call_api( self.client, method, **args )
+
     def load_cache( self ):
         with self.lock:
             self.cache_updated= False
@@ -58,6 +168,8 @@ class SlackAPI:
                 print( 'load', self.cache_file, flush=True )
                 self.user_map= cache.get( 'user', {} )
                 self.channel_map= cache.get( 'channel', {} )
+                self.channel_id_set= set( self.channel_map.values() )
+                self.channel_time= cache.get( 'channel_time', 0 )
                 self.all_channels= cache.get( 'all_channels', [] )
                 #self.all_users= cache.get( 'all_users', [] )
 
@@ -67,6 +179,7 @@ class SlackAPI:
                 save_json( self.cache_file, {
                         'user':self.user_map,
                         'channel':self.channel_map,
+                        'channel_time':self.channel_time,
                         'all_channels':self.all_channels,
                         #'all_users':self.all_users
                     } )
@@ -78,8 +191,7 @@ class SlackAPI:
         cursor= None
         try:
             while True:
-                result= self.client.conversations_list( cursor=cursor, limit=800, types="public_channel,private_channel" )
-                time.sleep( 1.0 )
+                result= self.call( 'conversations_list', cursor=cursor, limit=800, types="public_channel,private_channel" )
                 channels= result.get( "channels", [] )
                 all_channels.extend( channels )
                 cursor= result.get( 'response_metadata', {} ).get( 'next_cursor', None )
@@ -89,12 +201,19 @@ class SlackAPI:
             print( 'Error fetching channels: %s' % str(e.response['error']), flush=True )
             return
         with self.lock:
+            channel_map= dict( self.channel_map )
             for channel in all_channels:
                 channel_id= channel['id']
                 name= channel['name']
-                self.channel_map[name]= channel_id
+                channel_map[name]= channel_id
+            self.channel_time= time.time()
+            self.channel_miss_map.clear()
+            # 変化がなければ書き込まない
+            if channel_map != self.channel_map or len(all_channels) != len(self.all_channels):
+                self.channel_map= channel_map
+                self.channel_id_set= set( channel_map.values() )
+                self.cache_updated= True
             self.all_channels= all_channels
-            self.cache_updated= True
         self.save_cache()
 
     def update_users_( self ):
@@ -102,8 +221,7 @@ class SlackAPI:
         cursor= None
         try:
             while True:
-                result= self.client.users_list( cursor=cursor, limit=800 )
-                time.sleep( 1.0 )
+                result= self.call( 'users_list', cursor=cursor, limit=800 )
                 users= result.get( "members", [] )
                 all_users.extend( users )
                 cursor= result.get( 'response_metadata', {} ).get( 'next_cursor', None )
@@ -135,30 +253,49 @@ class SlackAPI:
 
     def get_all_channels( self ):
         if self.all_channels == []:
-            self.update_channels_()
+            self.refresh_channels( 0 )
         return  self.all_channels
 
     def get_channel_id_0( self, channel_name ):
         if channel_name.startswith( '#' ):
             channel_name= channel_name[1:]
-        if channel_name.startswith( 'C' ):
-            if channel_name in self.channel_map.values():
-                return  channel_name
+        if channel_name in self.channel_id_set:
+            return  channel_name
         if channel_name in self.channel_map:
             return  self.channel_map[channel_name]
         return  None
 
+    # 他のスレッドが取得中なら終わるのを待ち、その結果を使う
+    def refresh_channels( self, request_time ):
+        with self.refresh_lock:
+            if self.channel_time > request_time:
+                return
+            self.update_channels_()
+
+    # キャッシュから引く。見つからないときと CHANNEL_TTL を過ぎたときだけ一覧を取り直す
     def get_channel_id( self, channel_name ):
-        channel_id= self.get_channel_id_0( channel_name )
-        self.update_channels_()
-        return  self.get_channel_id_0( channel_name )
+        now= time.time()
+        with self.lock:
+            channel_id= self.get_channel_id_0( channel_name )
+            expired= now - self.channel_time >= self.CHANNEL_TTL
+            if channel_id is None:
+                miss_time= self.channel_miss_map.get( channel_name, 0 )
+                if now - miss_time < self.CHANNEL_MISS_WINDOW and not expired:
+                    return  None
+        if channel_id is not None and not expired:
+            return  channel_id
+        self.refresh_channels( now )
+        with self.lock:
+            channel_id= self.get_channel_id_0( channel_name )
+            if channel_id is None:
+                self.channel_miss_map[channel_name]= time.time()
+            return  channel_id
 
     def get_user_info( self, user_id ):
         if user_id in self.user_map:
             return  self.user_map[user_id]
         try:
-            response= self.client.users_info( user=user_id )
-            time.sleep( 0.5 )
+            response= self.call( 'users_info', user=user_id )
             user= response.get( 'user', {} )
             user_name= user.get( 'name', 'Unknown' )
             real_name= user.get( 'real_name', '' )
@@ -179,8 +316,7 @@ class SlackAPI:
     def post_message( self, channel_name, text, blocks=None, markdown_text= None, thread_ts=None ):
         try:
             channel_id= self.get_channel_id( channel_name )
-            response= self.client.chat_postMessage( channel=channel_id, text=text, blocks=blocks, markdown_text=markdown_text, thread_ts=thread_ts )
-            time.sleep( 1.0 )
+            response= self.call( 'chat_postMessage', channel=channel_id, text=text, blocks=blocks, markdown_text=markdown_text, thread_ts=thread_ts )
             return  response
         except SlackApiError as e:
             print( 'Error sending message: %s' % str(e.response['error']) )
@@ -226,7 +362,7 @@ def main( argv ):
 
     api= SlackAPI( SLACK_TOKEN )
     if command == 'update':
-        api.update_channels_()
+        api.refresh_channels( time.time() )
         api.update_users_()
     elif channel and command == 'post':
         api.post_message( channel, 'Test Message' )
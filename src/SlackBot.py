@@ -4,6 +4,7 @@
 import sys
 import os
 import time
+import threading
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_bolt.middleware.assistant import Assistant as SlackAssistant
@@ -12,6 +13,7 @@ lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
     sys.path.append( lib_path )
 import ChatEngine
+import SlackAPI
 
 # env:
 #  SLACK_BOT_TOKEN or SLACK_API_TOKEN
@@ -130,6 +132,71 @@ def respond_in_assistant_thread( payload, say, client, set_status ):
 
 #------------------------------------------------------------------------------
 
+# 先にプレースホルダを投稿し、生成途中のテキストで chat.update する
+class StreamUpdater:
+    PLACEHOLDER= '...'
+
+    def __init__( self, client, channel, thread_ts, interval ):
+        self.client= client
+        self.channel= channel
+        self.interval= interval
+        self.lock= threading.Lock()
+        self.text= ''
+        self.last_time= 0.0
+        self.ts= None
+        try:
+            response= SlackAPI.call_api( client, 'chat_postMessage', channel=channel, thread_ts=thread_ts, text=self.PLACEHOLDER )
+            self.ts= response.get( 'ts' )
+        except Exception as e:
+            print( f'Error placeholder:{e}\n' )
+
+    def update( self, text, blocks= None ):
+        try:
+            SlackAPI.call_api( self.client, 'chat_update', channel=self.channel, ts=self.ts, text=text, blocks=blocks )
+            return  True
+        except Exception as e:
+            print( f'Error update:{e}\n' )
+        return  False
+
+    # placeholder を消す
+    def delete( self ):
+        if self.ts is None:
+            return
+        with self.lock:
+            try:
+                SlackAPI.call_api( self.client, 'chat_delete', channel=self.channel, ts=self.ts )
+            except Exception as e:
+                print( f'Error delete:{e}\n' )
+            self.ts= None
+
+    def append( self, text ):
+        with self.lock:
+            self.text+= text
+            now= time.monotonic()
+            if self.ts is None or now - self.last_time < self.interval:
+                return
+            if self.text.strip() == '':
+                return
+            self.last_time= now
+            self.update( self.text + ' ' + self.PLACEHOLDER )
+
+    # 更新に失敗したら placeholder を消して False を返す。呼び出し側で通常の投稿をする
+    def finish( self, reply_text ):
+        if self.ts is None:
+            return  False
+        with self.lock:
+            result= self.update( reply_text, [
+                    {
+                        'type': 'markdown',
+                        'text': reply_text
+                    }
+                ])
+        if not result:
+            self.delete()
+        return  result
+
+#------------------------------------------------------------------------------
+
 class SlackBotApp:
     def __init__( self, options ):
         self.options= options
@@ -241,7 +308,7 @@ class SlackBotApp:
         ts= message.get( 'ts', '' )
         try:
             reaction_mark= 'robot_face'
-            client.reactions_add( channel=channel, timestamp=ts, name=reaction_mark )
+            SlackAPI.call_api( client, 'reactions_add', channel=channel, timestamp=ts, name=reaction_mark )
         except Exception as e:
             print( f'Error reaction:{e}\n' )
 
@@ -254,7 +321,24 @@ class SlackBotApp:
             'thread_ts': thread_ts,
         }
 
-        reply_text= self.chatbot.bot( thread_id, prompt, msg_id, msg_info )
+        updater= None
+        callback= None
+        if self.options.stream_update:
+            updater= StreamUpdater( client, channel, thread_ts, self.options.stream_update_interval )
+            callback= updater.append
+
+        def on_done( reply_text ):
+            self.reply_message( say, thread_ts, updater, reply_text )
+        self.chatbot.post_bot( thread_id, prompt, msg_id, msg_info, on_done, callback )
+
+    def reply_message( self, say, thread_ts, updater, reply_text ):
+        # 処理済みのメッセージだった
+        if reply_text is None:
+            if updater:
+                updater.delete()
+            return
+        if updater and updater.finish( reply_text ):
+            return
         say( text=reply_text, thread_ts=thread_ts, blocks= [
                 {
                     'type': 'markdown',
@@ -314,6 +398,9 @@ def usage():
     print( '  --model <model>' )
     print( '  --dm' )
     print( '  --assistant' )
+    print( '  --tasks <worker_count>' )
+    print( '  --stream' )
+    print( '  --write_behind' )
     print( '  --print' )
     print( '  --debug' )
     sys.exit( 1 )
@@ -340,8 +427,16 @@ def main( argv ):
                 ai= options.set_str( ai, argv, 'model' )
             elif arg == '--assistant':
                 options.assistant_mode= True
+            elif arg == '--tasks':
+                ai= options.set_int( ai, argv, 'task_worker_count' )
+                options.task_schedular= True
             elif arg == '--dm':
                 options.dm_enabled= True
+            elif arg == '--stream':
+                options.stream_update= True
+                options.streaming= True
+            elif arg == '--write_behind':
+                options.write_behind= True
             elif arg == '--noverify':
                 options.verify= False
             elif arg == '--print':
@@ -136,7 +136,7 @@ def get_channel_messages( channel: str, hours: int, max_count: int ) -> str:
     oldest= '%d' % ( now - hours * 3600 )
     latest= '%d' % int( now + 1 )
     try:
-        response= api.client.conversations_history( channel=channel_id, oldest=oldest, latest=latest, limit=max_count )
+        response= api.call( 'conversations_history', channel=channel_id, oldest=oldest, latest=latest, limit=max_count )
     except SlackApiError as e:
         return _api_error( e )
     messages= response.get( 'messages', [] )
@@ -183,7 +183,7 @@ def get_thread_messages( channel: str, thread_ts: str, max_count: int ) -> str:
     if channel_id is None:
         return 'Channel not found: "%s"' % channel
     try:
-        response= api.client.conversations_replies( channel=channel_id, ts=thread_ts, limit=max_count )
+        response= api.call( 'conversations_replies', channel=channel_id, ts=thread_ts, limit=max_count )
     except SlackApiError as e:
         return _api_error( e )
     messages= response.get( 'messages', [] )
@@ -253,7 +253,7 @@ def resolve_slack_user_id( name: str ) -> str:
     cursor= None
     try:
         while True:
-            r= api.client.users_list( cursor=cursor, limit=200 )
+            r= api.call( 'users_list', cursor=cursor, limit=200 )
             for u in r.get( 'members', [] ):
                 if u.get( 'deleted' ) or u.get( 'is_bot' ):
                     continue
@@ -279,7 +279,7 @@ def resolve_slack_user_id( name: str ) -> str:
 
 #------------------------------------------------------------------------------
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def post_slack_message( channel: str, text: str, thread_ts: str ) -> str:
     """
     Post a message to a Slack channel. Use thread_ts to reply within an existing thread,
@@ -5,12 +5,12 @@ import sys
 import re
 import shutil
 import subprocess
-import fnmatch
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
     sys.path.append( lib_path )
 from Functions import get_toolbox,ToolEnv
+import SourceIndex
 
 _RG= shutil.which( 'rg' )
 _SKIP_DIRS= frozenset( ['.git', '__pycache__', 'Intermediate', 'Binaries', 'DerivedDataCache', 'Saved'] )
@@ -131,11 +131,11 @@ def _rg_search( pattern, root, target, ext_set, case_sensitive, cap ):
 def _python_search( pattern, root, target, ext_set, case_sensitive, cap ):
     flags= 0 if case_sensitive else re.IGNORECASE
     try:
-        pat= re.compile( pattern, flags )
+        searcher= SourceIndex.TextSearcher( pattern, flags )
     except re.error as e:
         return 'Pattern error: ' + str( e ), False
     root_len= len( root ) + 1
-    results= []
+    file_list= []
     for dirpath, dirs, files in os.walk( target ):
         dirs[:]= [d for d in dirs if d not in _SKIP_DIRS]
         for name in files:
@@ -143,17 +143,8 @@ def _python_search( pattern, root, target, ext_set, case_sensitive, cap ):
                 _, ext= os.path.splitext( name )
                 if ext.lower() not in ext_set:
                     continue
-            full= os.path.join( dirpath, name )
-            try:
-                with open( full, 'r', encoding='utf-8', errors='ignore' ) as f:
-                    for lineno, line in enumerate( f, 1 ):
-                        if pat.search( line ):
-                            results.append( '%s:%d:%s' % ( full[root_len:], lineno, line.rstrip() ) )
-                            if len( results ) >= cap:
-                                return results, True
-            except OSError:
-                continue
-    return results, False
+            file_list.append( os.path.join( dirpath, name )[root_len:] )
+    return SourceIndex.search_files( searcher, root, file_list, cap )
 
 @mcp.tool()
 def search_text( env:ToolEnv, pattern: str, directory: str, extension: str, case_sensitive: bool, max_results: int ) -> str:
@@ -195,19 +186,15 @@ def search_text( env:ToolEnv, pattern: str, directory: str, extension: str, case
 
 #------------------------------------------------------------------------------
 
-def _resolve_file( root, file_path ):
+def _resolve_file( env, root, file_path ):
     candidate= _validate_path( root, file_path )
     if candidate and os.path.isfile( candidate ):
         return candidate
-    base= os.path.basename( file_path ).lower()
-    if not base or base in ( '.', '..' ):
+    index= SourceIndex.get_index( root, env )
+    rel_path= index.resolve( file_path )
+    if rel_path is None:
         return None
-    for dirpath, dirs, files in os.walk( root ):
-        dirs[:]= [d for d in dirs if d not in _SKIP_DIRS]
-        for name in files:
-            if name.lower() == base:
-                return os.path.join( dirpath, name )
-    return None
+    return os.path.join( index.root, rel_path )
 
 @mcp.tool()
 def read_file_range( env:ToolEnv, file_path: str, start_line: int, line_count: int ) -> str:
@@ -225,7 +212,7 @@ def read_file_range( env:ToolEnv, file_path: str, start_line: int, line_count: i
     root= _get_root( env )
     if not root:
         return 'MCP_FOLDER_ROOT is not set'
-    full= _resolve_file( root, file_path )
+    full= _resolve_file( env, root, file_path )
     if full is None:
         return 'File not found: "%s"' % file_path
     try:
@@ -259,20 +246,8 @@ def find_files( env:ToolEnv, name_pattern: str, directory: str ) -> str:
     target= _validate_path( root, directory )
     if target is None:
         return 'Invalid path: "%s"' % directory
-    pat= name_pattern.lower()
-    root_len= len( root ) + 1
-    results= []
-    truncated= False
-    for dirpath, dirs, files in os.walk( target ):
-        dirs[:]= [d for d in dirs if d not in _SKIP_DIRS]
-        for name in files:
-            if fnmatch.fnmatch( name.lower(), pat ):
-                results.append( os.path.join( dirpath, name )[root_len:] )
-                if len( results ) >= _MAX_LIST:
-                    truncated= True
-                    break
-        if truncated:
-            break
+    index= SourceIndex.get_index( root, env )
+    results, truncated= index.find_files( name_pattern, index.get_rel_dir( target ) or '', _MAX_LIST )
     if not results:
         return 'No files found matching "%s"' % name_pattern
     note= ' (showing first %d)' % _MAX_LIST if truncated else ''
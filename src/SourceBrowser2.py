@@ -3,20 +3,26 @@
 import os
 import sys
 import re
+import time
 import shutil
 import subprocess
 import fnmatch
+import threading
 from collections import OrderedDict
 
 lib_path= os.path.dirname(__file__)
 if lib_path not in sys.path:
     sys.path.append( lib_path )
 from Functions import get_toolbox,ToolEnv
+import SourceIndex
 
 _RG= shutil.which( 'rg' )
-_SKIP_DIRS= frozenset( ['.git', '__pycache__', 'Intermediate', 'Binaries', 'DerivedDataCache', 'Saved'] )
+_SKIP_DIRS= SourceIndex.SKIP_DIRS
 _MAX_LIST= 500
 _MAX_SEARCH= 500
+_RG_TIMEOUT= 30
+_SEARCH_CACHE_TTL= 60       # MCP_SEARCH_CACHE_TTL で変更できる。0 ならキャッシュしない
+_SEARCH_CACHE_SIZE= 64
 
 def _get_root( env ):
     return env.get( 'MCP_FOLDER_ROOT', env.get( 'MCP_SOURCE_ROOT', '' ) )
@@ -62,44 +68,20 @@ def _parse_extensions( ext_str ):
 
 #------------------------------------------------------------------------------
 
-def _list_files_impl( base, patterns, recursive ):
-    pairs= []
-    truncated= [False]
-    base_len= len( base ) + 1
-
-    def scan( path ):
-        if truncated[0]:
-            return
-        try:
-            entries= list( os.scandir( path ) )
-        except PermissionError:
-            return
-        files_here= []
-        sub_dirs= []
-        for entry in entries:
-            if entry.name in _SKIP_DIRS:
-                continue
-            if entry.is_dir( follow_symlinks=False ):
-                sub_dirs.append( entry.path )
-            elif entry.is_file( follow_symlinks=False ):
-                if _match_filename( entry.name.lower(), patterns ):
-                    files_here.append( entry.name )
-        files_here.sort()
-        rel_dir= path[base_len:] if path != base else ''
-        for fname in files_here:
-            pairs.append( ( rel_dir, fname ) )
-            if len( pairs ) >= _MAX_LIST:
-                truncated[0]= True
-                return
-        if recursive:
-            sub_dirs.sort()
-            for sd in sub_dirs:
-                if truncated[0]:
-                    return
-                scan( sd )
-
-    scan( base )
-    return pairs, truncated[0]
+def _list_files_impl( env, root, base, patterns, recursive ):
+    index= SourceIndex.get_index( root, env )
+    rel_base= index.get_rel_dir( base )
+    if rel_base is None:
+        return [], False
+    pairs, truncated= index.list_files( rel_base, recursive,
+                            lambda name: _match_filename( name.lower(), patterns ), _MAX_LIST )
+    base_len= len( rel_base ) + 1
+    result= []
+    for rel_dir, fname in pairs:
+        if rel_base:
+            rel_dir= rel_dir[base_len:] if rel_dir != rel_base else ''
+        result.append( ( rel_dir, fname ) )
+    return result, truncated
 
 def _format_grouped( pairs, header_path, truncated ):
     if not pairs:
@@ -139,11 +121,12 @@ def list_files( env:ToolEnv, directory: str, pattern: str, recursive: bool ) ->
     if not os.path.isdir( target ):
         return 'Directory not found: "%s"' % directory
     patterns= _parse_patterns( pattern )
-    pairs, truncated= _list_files_impl( target, patterns, recursive )
+    pairs, truncated= _list_files_impl( env, root, target, patterns, recursive )
     return _format_grouped( pairs, directory, truncated )
 
 #------------------------------------------------------------------------------
 
+# rg の出力を 1 行ずつ読み、cap 行を超えたらプロセスを止める
 def _rg_search( pattern, root, target, ext_set, case_sensitive, cap ):
     cmd= [_RG, '--line-number', '--no-heading', '--color=never', '--max-columns=300']
     if not case_sensitive:
@@ -153,45 +136,132 @@ def _rg_search( pattern, root, target, ext_set, case_sensitive, cap ):
             cmd.extend( ['--glob', '*' + ext] )
     cmd.extend( ['--', pattern, target] )
     try:
-        proc= subprocess.run( cmd, capture_output=True, text=True, encoding='utf-8',
-                              errors='replace', timeout=30 )
-        if proc.returncode == 2:
-            return None, False
-        root_prefix= root + os.sep
-        lines= []
-        for line in proc.stdout.splitlines():
+        proc= subprocess.Popen( cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                                encoding='utf-8', errors='replace' )
+    except OSError:
+        return None, False
+    timeout_flag= threading.Event()
+    def on_timeout():
+        timeout_flag.set()
+        proc.kill()
+    timer= threading.Timer( _RG_TIMEOUT, on_timeout )
+    timer.start()
+    root_prefix= root + os.sep
+    lines= []
+    truncated= False
+    try:
+        for line in proc.stdout:
+            line= line.rstrip( '\r\n' )
             lines.append( line[len( root_prefix ):] if line.startswith( root_prefix ) else line )
-        truncated= len( lines ) > cap
-        return lines[:cap], truncated
-    except subprocess.TimeoutExpired:
-        return [], False
-
-def _python_search( pattern, root, target, ext_set, case_sensitive, cap ):
+            if len( lines ) > cap:
+                truncated= True
+                break
+    finally:
+        timer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+    if timeout_flag.is_set():
+        return lines[:cap], True
+    if not truncated and proc.returncode == 2:
+        return None, False
+    return lines[:cap], truncated
+
+def _python_search( env, pattern, root, target, ext_set, case_sensitive, cap ):
     flags= 0 if case_sensitive else re.IGNORECASE
     try:
-        pat= re.compile( pattern, flags )
+        searcher= SourceIndex.TextSearcher( pattern, flags )
     except re.error as e:
         return 'Pattern error: ' + str( e ), False
-    root_len= len( root ) + 1
-    results= []
-    for dirpath, dirs, files in os.walk( target ):
-        dirs[:]= [d for d in dirs if d not in _SKIP_DIRS]
-        for name in files:
-            if ext_set:
-                _, ext= os.path.splitext( name )
-                if ext.lower() not in ext_set:
-                    continue
-            full= os.path.join( dirpath, name )
-            try:
-                with open( full, 'r', encoding='utf-8', errors='ignore' ) as f:
-                    for lineno, line in enumerate( f, 1 ):
-                        if pat.search( line ):
-                            results.append( '%s:%d:%s' % ( full[root_len:], lineno, line.rstrip() ) )
-                            if len( results ) >= cap:
-                                return results, True
-            except OSError:
+    index= SourceIndex.get_index( root, env )
+    rel_dir= index.get_rel_dir( target )
+    prefix= rel_dir + '/' if rel_dir else ''
+    file_list= []
+    for rel_path in index.get_all_files():
+        if prefix and not rel_path.startswith( prefix ):
+            continue
+        if ext_set:
+            _, ext= os.path.splitext( rel_path )
+            if ext.lower() not in ext_set:
                 continue
-    return results, False
+        file_list.append( rel_path )
+    return SourceIndex.search_files( searcher, index.root, file_list, cap )
+
+# trigram インデックスで候補を絞ってから検索する。絞り込めなければ None
+def _index_search( env, pattern, root, target, ext_set, case_sensitive, cap ):
+    flags= 0 if case_sensitive else re.IGNORECASE
+    try:
+        searcher= SourceIndex.TextSearcher( pattern, flags )
+    except re.error as e:
+        return 'Pattern error: ' + str( e ), False
+    trigram_index= SourceIndex.get_trigram_index( root, env )
+    rel_dir= trigram_index.source_index.get_rel_dir( target )
+    if rel_dir is None:
+        return None, False
+    candidate_list= trigram_index.find_candidates( SourceIndex.get_required_literals( pattern ), rel_dir, ext_set )
+    if candidate_list is None:
+        return None, False
+    return SourceIndex.search_files( searcher, trigram_index.source_index.root, candidate_list, cap )
+
+#------------------------------------------------------------------------------
+
+# 同じ条件の search_text の結果を再利用する
+#   root ごとに持ち、キーに SourceIndex の generation (ディレクトリの mtime で確認するファイルの追加と削除) を含める
+#   trigram インデックスが有効なら、その generation (ファイルの更新も含む) もキーに含める
+#   それ以外のファイルの編集は TTL を過ぎるまで反映されない
+_search_cache_lock= threading.Lock()
+_search_cache_map= {}    # root to OrderedDict( key to (create_time, cap, results, truncated) )
+
+def _get_search_cache_ttl( env ):
+    try:
+        return float( env.get( 'MCP_SEARCH_CACHE_TTL', _SEARCH_CACHE_TTL ) )
+    except ValueError:
+        return _SEARCH_CACHE_TTL
+
+def _get_search_generation( env, root ):
+    generation= SourceIndex.get_index( root, env ).get_generation()
+    if SourceIndex.is_search_index_enabled( env ):
+        return generation, SourceIndex.get_trigram_index( root, env ).get_generation()
+    return generation, None
+
+def _find_search_cache( root, key, cap, ttl ):
+    with _search_cache_lock:
+        search_cache= _search_cache_map.get( root )
+        if search_cache is None:
+            return None
+        entry= search_cache.get( key )
+        if entry is None:
+            return None
+        create_time, cache_cap, results, truncated= entry
+        if time.time() - create_time > ttl:
+            del search_cache[key]
+            return None
+        search_cache.move_to_end( key )
+    # 少ない cap で打ち切った結果は、より大きい cap には使えない
+    if truncated and cache_cap < cap:
+        return None
+    if len( results ) > cap:
+        return results[:cap], True
+    return results, truncated
+
+def _add_search_cache( root, key, create_time, cap, results, truncated ):
+    with _search_cache_lock:
+        search_cache= _search_cache_map.get( root )
+        if search_cache is None:
+            search_cache= OrderedDict()
+            _search_cache_map[root]= search_cache
+        search_cache[key]= ( create_time, cap, results, truncated )
+        search_cache.move_to_end( key )
+        while len( search_cache ) > _SEARCH_CACHE_SIZE:
+            search_cache.popitem( last=False )
+
+def _format_search_results( pattern, results, truncated ):
+    if not results:
+        return 'No matches found for "%s"' % pattern
+    note= ', truncated' if truncated else ''
+    header= '**Results for "%s"** (%d matches%s):\n\n' % ( pattern, len( results ), note )
+    return header + '\n'.join( results )
 
 @mcp.tool()
 def search_text( env:ToolEnv, pattern: str, directory: str, extension: str, case_sensitive: bool, max_results: int ) -> str:
@@ -216,36 +286,42 @@ def search_text( env:ToolEnv, pattern: str, directory: str, extension: str, case
     ext_set= _parse_extensions( extension )
     cap= min( max_results, _MAX_SEARCH )
 
+    ttl= _get_search_cache_ttl( env )
+    if ttl > 0:
+        real_root= os.path.realpath( root )
+        generation= _get_search_generation( env, real_root )
+        key= ( generation, target, pattern, tuple( sorted( ext_set ) ) if ext_set else (), case_sensitive )
+        cached= _find_search_cache( real_root, key, cap, ttl )
+        if cached is not None:
+            results, truncated= cached
+            return _format_search_results( pattern, results, truncated )
+        create_time= time.time()
+
     results= None
     truncated= False
-    if _RG:
+    if SourceIndex.is_search_index_enabled( env ):
+        results, truncated= _index_search( env, pattern, root, target, ext_set, case_sensitive, cap )
+    if results is None and _RG:
         results, truncated= _rg_search( pattern, root, target, ext_set, case_sensitive, cap )
     if results is None:
-        results, truncated= _python_search( pattern, root, target, ext_set, case_sensitive, cap )
+        results, truncated= _python_search( env, pattern, root, target, ext_set, case_sensitive, cap )
     if isinstance( results, str ):
         return results
-
-    if not results:
-        return 'No matches found for "%s"' % pattern
-    note= ', truncated' if truncated else ''
-    header= '**Results for "%s"** (%d matches%s):\n\n' % ( pattern, len( results ), note )
-    return header + '\n'.join( results )
+    if ttl > 0:
+        _add_search_cache( real_root, key, create_time, cap, results, truncated )
+    return _format_search_results( pattern, results, truncated )
 
 #------------------------------------------------------------------------------
 
-def _resolve_file( root, file_path ):
+def _resolve_file( env, root, file_path ):
     candidate= _validate_path( root, file_path )
     if candidate and os.path.isfile( candidate ):
         return candidate
-    base= os.path.basename( file_path ).lower()
-    if not base or base in ( '.', '..' ):
+    index= SourceIndex.get_index( root, env )
+    rel_path= index.resolve( file_path )
+    if rel_path is None:
         return None
-    for dirpath, dirs, files in os.walk( root ):
-        dirs[:]= [d for d in dirs if d not in _SKIP_DIRS]
-        for name in files:
-            if name.lower() == base:
-                return os.path.join( dirpath, name )
-    return None
+    return os.path.join( index.root, rel_path )
 
 @mcp.tool()
 def read_file_range( env:ToolEnv, file_path: str, start_line: int, line_count: int ) -> str:
@@ -263,7 +339,7 @@ def read_file_range( env:ToolEnv, file_path: str, start_line: int, line_count: i
     root= _get_root( env )
     if not root:
         return 'MCP_FOLDER_ROOT is not set'
-    full= _resolve_file( root, file_path )
+    full= _resolve_file( env, root, file_path )
     if full is None:
         return 'File not found: "%s"' % file_path
     try:
@@ -275,10 +351,37 @@ def read_file_range( env:ToolEnv, file_path: str, start_line: int, line_count: i
     s= max( 0, start_line - 1 )
     end= total if line_count <= 0 else min( total, s + line_count )
     selected= lines[s:end]
-    rel= full[len( root ) + 1:]
+    # _resolve_file は realpath の root 以下のパスを返す
+    rel= full[len( os.path.realpath( root ) ) + 1:].replace( os.sep, '/' )
     header= '** File: %s  lines %d-%d / %d **\n\n' % ( rel, s + 1, s + len( selected ), total )
     return header + ''.join( '%5d  %s' % ( s + i + 1, line ) for i, line in enumerate( selected ) )
 
+#------------------------------------------------------------------------------
+
+@mcp.tool()
+def find_source_files( env:ToolEnv, name_pattern: str, directory: str ) -> str:
+    """
+    Find files by filename pattern. Supports wildcards (* matches any characters, ? matches one character).
+    Returns paths relative to the source root.
+
+    Args:
+        name_pattern: Filename pattern with optional wildcards. e.g. "*DebugMenu*", "*.Build.cs", "Player*.h"
+        directory: Relative path from the source root to search in. Use empty string to search all.
+    """
+    root= _get_root( env )
+    if not root:
+        return 'MCP_FOLDER_ROOT is not set'
+    target= _validate_path( root, directory )
+    if target is None:
+        return 'Invalid path: "%s"' % directory
+    index= SourceIndex.get_index( root, env )
+    results, truncated= index.find_files( name_pattern, index.get_rel_dir( target ) or '', _MAX_LIST )
+    if not results:
+        return 'No files found matching "%s"' % name_pattern
+    note= ' (showing first %d)' % _MAX_LIST if truncated else ''
+    header= '**Files matching "%s"** (%d%s):\n\n' % ( name_pattern, len( results ), note )
+    return header + '\n'.join( '- ' + f for f in results )
+
 
 
 def main():
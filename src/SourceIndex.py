@@ -0,0 +1,798 @@
+# vim:ts=4 sw=4 et:
+
+import io
+import os
+import re
+import sys
+import time
+import json
+import gzip
+import base64
+import hashlib
+import fnmatch
+import threading
+import array
+import concurrent.futures
+from collections import deque
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# ソースツリーのファイル名インデックス
+#   root ごとに 1 つ作り、ディレクトリの mtime で差分更新する
+#   MCP_INDEX_DIR (default ~/.cache/mcp_index) に保存して次回の起動時に再利用する
+#   MCP_INDEX_DIR を空にすると保存しない
+#   MCP_SEARCH_INDEX=1 なら search_text 用の trigram インデックスも作る
+
+INDEX_VERSION= 3
+CHECK_INTERVAL= 10.0        # この秒数以内なら更新確認をしない
+CHANGE_LOG_SIZE= 65536      # get_changes() 用に覚えておく変更の数
+SKIP_DIRS= frozenset( ['.git', '__pycache__', 'Intermediate', 'Binaries', 'DerivedDataCache', 'Saved'] )
+
+def _join( rel_dir, name ):
+    return rel_dir + '/' + name if rel_dir else name
+
+#------------------------------------------------------------------------------
+
+class SourceIndex:
+    def __init__( self, root, index_dir= None ):
+        self.lock= threading.Lock()
+        self.root= os.path.realpath( root )
+        self.index_dir= index_dir
+        self.dir_map= {}        # rel_dir to [mtime_ns, [file_name], [dir_name], [symlink の file_name]]
+        self.path_map= {}       # rel_path to 小文字の rel_path
+        self.lower_map= {}      # 小文字の rel_path to [rel_path] (大文字小文字だけ違うファイルもすべて)
+        self.base_map= {}       # 小文字の basename to [rel_path]
+        self.check_time= 0.0
+        self.generation= 0      # ファイルの追加、削除のたびに増える。track_stats なら更新でも増える
+        self.loaded= False
+        # ファイルの mtime とサイズ (get_changes() を呼ぶまでは調べない)
+        self.track_stats= False
+        self.stat_map= {}       # rel_path to [mtime_ns, size]
+        self.change_seq= 0
+        self.change_base_seq= 0 # これより後の変更はすべて change_list にある
+        self.change_list= deque()   # (seq, rel_path)
+
+    #--------------------------------------------------------------------------
+
+    def get_cache_file( self ):
+        if not self.index_dir:
+            return None
+        key= hashlib.sha1( self.root.encode( 'utf-8' ) ).hexdigest()[:16]
+        return os.path.join( self.index_dir, 'files_%s.json.gz' % key )
+
+    def load_cache_0( self ):
+        cache_file= self.get_cache_file()
+        if not cache_file or not os.path.exists( cache_file ):
+            return False
+        try:
+            with gzip.open( cache_file, 'rt', encoding='utf-8' ) as fi:
+                data= json.loads( fi.read() )
+        except (OSError, ValueError):
+            return False
+        if data.get( 'version' ) != INDEX_VERSION or data.get( 'root' ) != self.root:
+            return False
+        self.dir_map= data.get( 'dirs', {} )
+        return True
+
+    def save_cache_0( self ):
+        cache_file= self.get_cache_file()
+        if not cache_file:
+            return
+        try:
+            os.makedirs( self.index_dir, exist_ok=True )
+            tmp_file= cache_file + '.%d.tmp' % os.getpid()
+            with gzip.open( tmp_file, 'wt', encoding='utf-8' ) as fo:
+                fo.write( json.dumps( { 'version': INDEX_VERSION, 'root': self.root, 'dirs': self.dir_map } ) )
+            os.replace( tmp_file, cache_file )
+        except OSError:
+            pass
+
+    #--------------------------------------------------------------------------
+    # Lock の中から呼ぶ想定の命令
+
+    def scan_dir_0( self, rel_dir ):
+        path= os.path.join( self.root, rel_dir ) if rel_dir else self.root
+        try:
+            mtime= os.stat( path ).st_mtime_ns
+            entries= list( os.scandir( path ) )
+        except OSError:
+            self.dir_map.pop( rel_dir, None )
+            return
+        files= []
+        dirs= []
+        links= []
+        for entry in entries:
+            if entry.name in SKIP_DIRS:
+                continue
+            try:
+                if entry.is_dir( follow_symlinks=False ):
+                    dirs.append( entry.name )
+                elif entry.is_file( follow_symlinks=False ):
+                    files.append( entry.name )
+                elif entry.is_symlink() and entry.is_file():
+                    links.append( entry.name )
+            except OSError:
+                continue
+        files.sort()
+        dirs.sort()
+        links.sort()
+        old= self.dir_map.get( rel_dir )
+        self.dir_map[rel_dir]= [mtime, files, dirs, links]
+        old_dirs= set( old[2] ) if old else set()
+        for name in dirs:
+            if name not in old_dirs:
+                self.scan_tree_0( _join( rel_dir, name ) )
+        for name in old_dirs - set( dirs ):
+            self.remove_tree_0( _join( rel_dir, name ) )
+
+    def scan_tree_0( self, rel_dir ):
+        self.scan_dir_0( rel_dir )
+        entry= self.dir_map.get( rel_dir )
+        if entry:
+            for name in entry[2]:
+                if _join( rel_dir, name ) not in self.dir_map:
+                    self.scan_tree_0( _join( rel_dir, name ) )
+
+    def remove_tree_0( self, rel_dir ):
+        entry= self.dir_map.pop( rel_dir, None )
+        if entry:
+            for name in entry[2]:
+                self.remove_tree_0( _join( rel_dir, name ) )
+
+    # mtime が変わったディレクトリだけ読み直す。変化があれば True
+    def update_0( self ):
+        changed= False
+        for rel_dir in list( self.dir_map.keys() ):
+            entry= self.dir_map.get( rel_dir )
+            if entry is None:
+                continue
+            path= os.path.join( self.root, rel_dir ) if rel_dir else self.root
+            try:
+                mtime= os.stat( path ).st_mtime_ns
+            except OSError:
+                self.remove_tree_0( rel_dir )
+                changed= True
+                continue
+            if mtime != entry[0]:
+                self.scan_dir_0( rel_dir )
+                changed= True
+        return changed
+
+    def add_change_0( self, rel_path ):
+        self.change_seq+= 1
+        self.change_list.append( ( self.change_seq, rel_path ) )
+        if len( self.change_list ) > CHANGE_LOG_SIZE:
+            self.change_base_seq= self.change_list.popleft()[0]
+
+    # 全ファイルの mtime とサイズを調べて変わったものを記録する。変化があれば True
+    #   初回は記録せずに change_base_seq を進めるので、利用側は全体を比較し直す
+    def update_stats_0( self ):
+        first= not self.stat_map and self.change_seq == 0
+        changed= False
+        stat_map= {}
+        for rel_path in self.path_map:
+            try:
+                st= os.stat( os.path.join( self.root, rel_path ) )
+            except OSError:
+                continue
+            stat= [st.st_mtime_ns, st.st_size]
+            stat_map[rel_path]= stat
+            if not first and self.stat_map.get( rel_path ) != stat:
+                self.add_change_0( rel_path )
+                changed= True
+        if not first:
+            for rel_path in self.stat_map.keys() - stat_map.keys():
+                self.add_change_0( rel_path )
+                changed= True
+        else:
+            self.change_seq+= 1
+            self.change_base_seq= self.change_seq
+            changed= True
+        self.stat_map= stat_map
+        return changed
+
+    def rebuild_map_0( self ):
+        path_map= {}
+        lower_map= {}
+        base_map= {}
+        for rel_dir in sorted( self.dir_map.keys() ):
+            entry= self.dir_map[rel_dir]
+            for name in sorted( entry[1] + entry[3] ):
+                rel_path= _join( rel_dir, name )
+                lower_path= rel_path.lower()
+                path_map[rel_path]= lower_path
+                lower_map.setdefault( lower_path, [] ).append( rel_path )
+                base_map.setdefault( name.lower(), [] ).append( rel_path )
+        self.path_map= path_map
+        self.lower_map= lower_map
+        self.base_map= base_map
+        self.generation+= 1
+
+    def refresh_0( self, force= False ):
+        now= time.monotonic()
+        if self.loaded and not force and now - self.check_time < CHECK_INTERVAL:
+            return
+        if not self.loaded:
+            self.loaded= True
+            if self.load_cache_0():
+                self.update_0()
+            else:
+                self.dir_map= {}
+                self.scan_tree_0( '' )
+            self.rebuild_map_0()
+            self.save_cache_0()
+        elif self.update_0():
+            self.rebuild_map_0()
+            self.save_cache_0()
+        if self.track_stats and self.update_stats_0():
+            self.generation+= 1
+        self.check_time= time.monotonic()
+
+    def enable_stats_0( self ):
+        if not self.track_stats:
+            self.track_stats= True
+            self.refresh_0( True )
+
+    #--------------------------------------------------------------------------
+
+    def get_rel_dir( self, path ):
+        path= os.path.realpath( path )
+        if path == self.root:
+            return ''
+        if not path.startswith( self.root + os.sep ):
+            return None
+        return path[len( self.root ) + 1:].replace( os.sep, '/' )
+
+    # root からの相対パスのリスト (パス順)
+    def get_all_files( self ):
+        with self.lock:
+            self.refresh_0()
+            return sorted( self.path_map )
+
+    # ディレクトリの mtime だけで確認するので、ファイルの中身の変更は get_changes() の利用者がいるときだけ反映される
+    def get_generation( self ):
+        with self.lock:
+            self.refresh_0()
+            return self.generation
+
+    # since_seq 以降に追加、削除、更新されたファイル
+    #   (seq, { rel_path: [mtime_ns, size] または削除なら None }, full) を返す
+    #   since_seq が None か古すぎる場合は full=True で全ファイルの一覧を返す
+    def get_changes( self, since_seq ):
+        with self.lock:
+            self.enable_stats_0()
+            self.refresh_0()
+            if since_seq is None or since_seq < self.change_base_seq:
+                return self.change_seq, dict( self.stat_map ), True
+            change_map= {}
+            for seq, rel_path in reversed( self.change_list ):
+                if seq <= since_seq:
+                    break
+                change_map[rel_path]= self.stat_map.get( rel_path )
+            return self.change_seq, change_map, False
+
+    # (rel_dir, file_name) のリスト。ディレクトリ内はファイル、サブディレクトリの順
+    #   symlink のファイルは含めない
+    def list_files( self, rel_dir, recursive, match_func= None, limit= 0 ):
+        with self.lock:
+            self.refresh_0()
+            pairs= []
+            stack= [rel_dir]
+            while stack:
+                current= stack.pop()
+                entry= self.dir_map.get( current )
+                if entry is None:
+                    continue
+                for name in entry[1]:
+                    if match_func is None or match_func( name ):
+                        pairs.append( ( current, name ) )
+                        if limit and len( pairs ) >= limit:
+                            return pairs, True
+                if recursive:
+                    for name in reversed( entry[2] ):
+                        stack.append( _join( current, name ) )
+            return pairs, False
+
+    # ファイル名のワイルドカードで検索する
+    def find_files( self, name_pattern, rel_dir= '', limit= 0 ):
+        pat= name_pattern.lower()
+        prefix= rel_dir + '/' if rel_dir else ''
+        with self.lock:
+            self.refresh_0()
+            results= []
+            for base in sorted( self.base_map.keys() ):
+                if not fnmatch.fnmatch( base, pat ):
+                    continue
+                for rel_path in self.base_map[base]:
+                    if rel_path.startswith( prefix ):
+                        results.append( rel_path )
+            results.sort()
+            if limit and len( results ) > limit:
+                return results[:limit], True
+            return results, False
+
+    # ファイル名だけ、途中からのパス、root からのパスのいずれかで探す
+    #   大文字小文字まで一致するものを優先し、候補が複数ある場合はパスの順で先頭のもの
+    def resolve( self, file_path ):
+        exact_path= file_path.replace( '\\', '/' ).strip( '/' )
+        while exact_path.startswith( './' ):
+            exact_path= exact_path[2:]
+        if not exact_path:
+            return None
+        path= exact_path.lower()
+        base= path.rsplit( '/', 1 )[-1]
+        if base in ( '.', '..' ):
+            return None
+        with self.lock:
+            self.refresh_0()
+            if exact_path in self.path_map:
+                return exact_path
+            candidate_list= self.lower_map.get( path )
+            if candidate_list:
+                return candidate_list[0]
+            exact_suffix= '/' + exact_path
+            for rel_path in self.base_map.get( base, [] ):
+                if rel_path.endswith( exact_suffix ):
+                    return rel_path
+            suffix= '/' + path
+            for rel_path in self.base_map.get( base, [] ):
+                if self.path_map[rel_path].endswith( suffix ):
+                    return rel_path
+            if '/' in path:
+                # ディレクトリ部分が一致しない場合はファイル名だけで探す
+                candidate_list= self.base_map.get( base, [] )
+                if candidate_list:
+                    return candidate_list[0]
+            return None
+
+#------------------------------------------------------------------------------
+
+# 正規表現が一致するために必ず含まれる文字列を取り出す
+#   分岐 (|) や文字クラスは無視するので、取り出せない場合は空
+def get_required_literals( pattern ):
+    try:
+        parsed= sre_parse.parse( pattern )
+    except Exception:
+        return []
+    literal_list= []
+
+    def walk( items ):
+        current= ''
+        for op, av in items:
+            if op == sre_parse.LITERAL:
+                current+= chr( av )
+                continue
+            if current:
+                literal_list.append( current )
+                current= ''
+            if op == sre_parse.SUBPATTERN:
+                walk( av[-1] )
+            elif op in ( sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT ) and av[0] >= 1:
+                walk( av[2] )
+        if current:
+            literal_list.append( current )
+
+    walk( parsed )
+    return literal_list
+
+# 3 バイトの組を 24bit の整数にしたもの
+def _get_trigrams( data ):
+    return { ( a << 16 ) | ( b << 8 ) | c for a, b, c in set( zip( data, data[1:], data[2:] ) ) }
+
+def _encode_ids( id_list ):
+    data= array.array( 'I', id_list )
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return base64.b64encode( data.tobytes() ).decode( 'ascii' )
+
+def _decode_ids( encoded ):
+    data= array.array( 'I' )
+    data.frombytes( base64.b64decode( encoded ) )
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data
+
+
+# 全文検索用の trigram インデックス (MCP_SEARCH_INDEX=1 のときだけ使う)
+#   小文字にしたファイル内容の 3 バイトの組を記録し、検索時に候補ファイルを絞り込む
+#   SourceIndex.get_changes() で変わったファイルだけ読み直す
+#   posting は file_id の配列で、削除や更新で不要になった id は検索時に除き、増えたらまとめて消す
+#   保存は全体 (trigram_<key>.json.gz) と差分 (trigram_<key>.<n>.json.gz) に分け、差分が増えたら全体を書き直す
+class TrigramIndex:
+    MAX_FILE_SIZE= 1024 * 1024      # これより大きいファイルは常に候補にする
+    BINARY_CHECK_SIZE= 8192
+    MAX_SEGMENTS= 8
+
+    KIND_TEXT= 0
+    KIND_LARGE= 1
+    KIND_BINARY= 2
+
+    def __init__( self, source_index ):
+        self.lock= threading.Lock()
+        self.source_index= source_index
+        self.file_map= {}       # rel_path to [file_id, mtime_ns, size, kind]
+        self.id_map= {}         # 有効な file_id to rel_path
+        self.posting_map= {}    # trigram to array( file_id )。無効な file_id も含む
+        self.large_set= set()   # KIND_LARGE の file_id
+        self.next_id= 0
+        self.dead_count= 0      # posting に残っている無効な file_id の数
+        self.change_seq= None
+        self.serial= None       # 差分がどの全体保存に対するものか
+        self.segment_count= 0
+        self.loaded= False
+
+    def get_cache_file( self, segment= None ):
+        cache_file= self.source_index.get_cache_file()
+        if not cache_file:
+            return None
+        cache_file= cache_file.replace( 'files_', 'trigram_' )
+        if segment is not None:
+            cache_file= cache_file.replace( '.json.gz', '.%d.json.gz' % segment )
+        return cache_file
+
+    def read_json( self, cache_file ):
+        try:
+            with gzip.open( cache_file, 'rt', encoding='utf-8' ) as fi:
+                data= json.loads( fi.read() )
+        except (OSError, ValueError):
+            return None
+        if data.get( 'version' ) != INDEX_VERSION or data.get( 'root' ) != self.source_index.root:
+            return None
+        return data
+
+    def write_json( self, cache_file, data ):
+        try:
+            os.makedirs( self.source_index.index_dir, exist_ok=True )
+            tmp_file= cache_file + '.%d.tmp' % os.getpid()
+            with gzip.open( tmp_file, 'wt', encoding='utf-8' ) as fo:
+                fo.write( json.dumps( data ) )
+            os.replace( tmp_file, cache_file )
+            return True
+        except OSError:
+            return False
+
+    #--------------------------------------------------------------------------
+    # Lock の中から呼ぶ想定の命令
+
+    def load_cache_0( self ):
+        cache_file= self.get_cache_file()
+        if not cache_file or not os.path.exists( cache_file ):
+            return
+        data= self.read_json( cache_file )
+        if data is None:
+            return
+        self.serial= data.get( 'serial' )
+        self.next_id= data.get( 'next_id', 0 )
+        for rel_path, file_id, mtime, size, kind in data.get( 'files', [] ):
+            self.set_file_0( rel_path, file_id, mtime, size, kind )
+        for trigram, encoded in data.get( 'postings', [] ):
+            self.posting_map[trigram]= _decode_ids( encoded )
+        # 差分を順に適用する
+        while True:
+            data= self.read_json( self.get_cache_file( self.segment_count ) )
+            if data is None or data.get( 'serial' ) != self.serial:
+                break
+            self.segment_count+= 1
+            for rel_path in data.get( 'removed', [] ):
+                self.remove_file_0( rel_path )
+            for rel_path, file_id, mtime, size, kind, encoded in data.get( 'files', [] ):
+                self.add_file_0( rel_path, file_id, mtime, size, kind, _decode_ids( encoded ) )
+            self.next_id= max( self.next_id, data.get( 'next_id', 0 ) )
+
+    # 全体を書き出して差分を消す
+    def save_base_0( self ):
+        cache_file= self.get_cache_file()
+        if not cache_file:
+            return
+        self.compact_0()
+        self.serial= '%d.%d' % ( os.getpid(), time.time_ns() )
+        data= {
+            'version': INDEX_VERSION,
+            'root': self.source_index.root,
+            'serial': self.serial,
+            'next_id': self.next_id,
+            'files': [[rel_path] + entry for rel_path, entry in self.file_map.items()],
+            'postings': [[trigram, _encode_ids( posting )] for trigram, posting in self.posting_map.items()],
+        }
+        if not self.write_json( cache_file, data ):
+            return
+        for segment in range( self.segment_count ):
+            try:
+                os.remove( self.get_cache_file( segment ) )
+            except OSError:
+                pass
+        self.segment_count= 0
+
+    def save_segment_0( self, added_list, removed_list ):
+        if not self.get_cache_file():
+            return
+        if self.serial is None or self.segment_count >= self.MAX_SEGMENTS:
+            self.save_base_0()
+            return
+        data= {
+            'version': INDEX_VERSION,
+            'root': self.source_index.root,
+            'serial': self.serial,
+            'next_id': self.next_id,
+            'files': added_list,
+            'removed': removed_list,
+        }
+        if self.write_json( self.get_cache_file( self.segment_count ), data ):
+            self.segment_count+= 1
+
+    def set_file_0( self, rel_path, file_id, mtime, size, kind ):
+        self.file_map[rel_path]= [file_id, mtime, size, kind]
+        self.id_map[file_id]= rel_path
+        if kind == self.KIND_LARGE:
+            self.large_set.add( file_id )
+
+    def add_file_0( self, rel_path, file_id, mtime, size, kind, trigram_list ):
+        self.remove_file_0( rel_path )
+        self.set_file_0( rel_path, file_id, mtime, size, kind )
+        for trigram in trigram_list:
+            posting= self.posting_map.get( trigram )
+            if posting is None:
+                posting= array.array( 'I' )
+                self.posting_map[trigram]= posting
+            posting.append( file_id )
+
+    def remove_file_0( self, rel_path ):
+        entry= self.file_map.pop( rel_path, None )
+        if entry is None:
+            return
+        file_id= entry[0]
+        del self.id_map[file_id]
+        self.large_set.discard( file_id )
+        self.dead_count+= 1
+
+    # 無効な file_id を posting から消す
+    def compact_0( self ):
+        if self.dead_count == 0:
+            return
+        id_map= self.id_map
+        posting_map= {}
+        for trigram, posting in self.posting_map.items():
+            posting= array.array( 'I', [file_id for file_id in posting if file_id in id_map] )
+            if posting:
+                posting_map[trigram]= posting
+        self.posting_map= posting_map
+        self.dead_count= 0
+
+    # 追加したなら [rel_path, file_id, mtime, size, kind, encoded] を返す
+    def index_file_0( self, rel_path, stat ):
+        kind= self.KIND_TEXT
+        trigram_list= []
+        if stat[1] > self.MAX_FILE_SIZE:
+            kind= self.KIND_LARGE
+        else:
+            try:
+                with open( os.path.join( self.source_index.root, rel_path ), 'rb' ) as fi:
+                    data= fi.read()
+            except OSError:
+                self.remove_file_0( rel_path )
+                return None
+            if b'\0' in data[:self.BINARY_CHECK_SIZE]:
+                kind= self.KIND_BINARY
+            else:
+                trigram_list= sorted( _get_trigrams( data.lower() ) )
+        file_id= self.next_id
+        self.next_id+= 1
+        self.add_file_0( rel_path, file_id, stat[0], stat[1], kind, trigram_list )
+        return [rel_path, file_id, stat[0], stat[1], kind, _encode_ids( trigram_list )]
+
+    def refresh_0( self ):
+        if not self.loaded:
+            self.loaded= True
+            self.load_cache_0()
+        seq, change_map, full= self.source_index.get_changes( self.change_seq )
+        self.change_seq= seq
+        removed_list= []
+        if full:
+            for rel_path in list( self.file_map.keys() ):
+                if rel_path not in change_map:
+                    removed_list.append( rel_path )
+        added_list= []
+        for rel_path, stat in change_map.items():
+            entry= self.file_map.get( rel_path )
+            if stat is None:
+                if entry:
+                    removed_list.append( rel_path )
+                continue
+            if entry and entry[1] == stat[0] and entry[2] == stat[1]:
+                continue
+            added= self.index_file_0( rel_path, stat )
+            if added:
+                added_list.append( added )
+            elif entry:
+                removed_list.append( rel_path )
+        for rel_path in removed_list:
+            self.remove_file_0( rel_path )
+        if not added_list and not removed_list:
+            return
+        if self.dead_count > len( self.id_map ):
+            self.compact_0()
+        self.save_segment_0( added_list, removed_list )
+
+    # 取り込み済みの SourceIndex の変更の seq (ファイルの追加、削除、更新を反映するたびに増える)
+    def get_generation( self ):
+        with self.lock:
+            self.refresh_0()
+            return self.change_seq
+
+    #--------------------------------------------------------------------------
+
+    # literal_list をすべて含む可能性があるファイル (パス順)
+    #   3 文字以上の literal がなければ絞り込めないので None
+    #   bytes.lower() は ASCII しか変換しないので ASCII 以外を含む literal は使わない
+    def find_candidates( self, literal_list, rel_dir= '', ext_set= None ):
+        trigram_set= set()
+        for literal in literal_list:
+            if literal.isascii():
+                trigram_set|= _get_trigrams( literal.lower().encode( 'ascii' ) )
+        if not trigram_set:
+            return None
+        prefix= rel_dir + '/' if rel_dir else ''
+        with self.lock:
+            self.refresh_0()
+            posting_list= [self.posting_map.get( trigram, () ) for trigram in trigram_set]
+            posting_list.sort( key=len )
+            candidate_set= set( posting_list[0] )
+            for posting in posting_list[1:]:
+                if not candidate_set:
+                    break
+                candidate_set.intersection_update( posting )
+            candidate_set|= self.large_set
+            path_list= [self.id_map[file_id] for file_id in candidate_set if file_id in self.id_map]
+        result= []
+        for rel_path in sorted( path_list ):
+            if prefix and not rel_path.startswith( prefix ):
+                continue
+            if ext_set:
+                _, ext= os.path.splitext( rel_path )
+                if ext.lower() not in ext_set:
+                    continue
+            result.append( rel_path )
+        return result
+
+#------------------------------------------------------------------------------
+
+_index_lock= threading.Lock()
+_index_map= {}
+_trigram_map= {}
+
+# MCP_INDEX_DIR が無ければユーザーのキャッシュディレクトリに置く
+def get_default_index_dir():
+    if os.name == 'nt':
+        cache_root= os.environ.get( 'LOCALAPPDATA', os.path.expanduser( '~' ) )
+    else:
+        cache_root= os.environ.get( 'XDG_CACHE_HOME', os.path.join( os.path.expanduser( '~' ), '.cache' ) )
+    return os.path.join( cache_root, 'mcp_index' )
+
+def get_index_dir( env= None ):
+    if env is not None:
+        return env.get( 'MCP_INDEX_DIR', get_default_index_dir() )
+    return os.environ.get( 'MCP_INDEX_DIR', get_default_index_dir() )
+
+def get_index( root, env= None ):
+    real_root= os.path.realpath( root )
+    with _index_lock:
+        index= _index_map.get( real_root )
+        if index is None:
+            index= SourceIndex( real_root, get_index_dir( env ) )
+            _index_map[real_root]= index
+        return index
+
+def is_search_index_enabled( env= None ):
+    if env is not None:
+        return env.get( 'MCP_SEARCH_INDEX', '' ) == '1'
+    return os.environ.get( 'MCP_SEARCH_INDEX', '' ) == '1'
+
+def get_trigram_index( root, env= None ):
+    index= get_index( root, env )
+    with _index_lock:
+        trigram_index= _trigram_map.get( index.root )
+        if trigram_index is None:
+            trigram_index= TrigramIndex( index )
+            _trigram_map[index.root]= trigram_index
+        return trigram_index
+
+#------------------------------------------------------------------------------
+
+# rg が無いときのファイル内容の検索
+#   bytes のまま読んでバイナリを除き、必須の literal が含まれないファイルは正規表現を当てずに捨てる
+#   さらにファイル全体に 1 回だけ正規表現を当ててから、一致したファイルだけ行ごとに調べる
+class TextSearcher:
+    BINARY_CHECK_SIZE= 8192
+
+    def __init__( self, pattern, flags= 0 ):
+        self.pat= re.compile( pattern, flags )
+        # bytes.lower() は ASCII しか変換しないので ASCII の literal だけ使う
+        self.literal_list= [literal.lower().encode( 'ascii' ) for literal in get_required_literals( pattern ) if literal.isascii()]
+        # \A, \Z と後読みは行単位とファイル全体で結果が変わるので全体の確認をしない
+        self.file_pat= None
+        if not re.search( r'\\[AZ]|\(\?<[=!]', pattern ):
+            self.file_pat= re.compile( pattern, flags|re.MULTILINE )
+
+    # 一致する可能性があるファイルならテキスト、無ければ None
+    def read_text( self, full_path, file_check= True ):
+        try:
+            with open( full_path, 'rb' ) as fi:
+                data= fi.read()
+        except OSError:
+            return None
+        if b'\0' in data[:self.BINARY_CHECK_SIZE]:
+            return None
+        if self.literal_list:
+            lower_data= data.lower()
+            for literal in self.literal_list:
+                if literal not in lower_data:
+                    return None
+        text= data.decode( 'utf-8', errors='ignore' )
+        if '\r' in text:
+            text= text.replace( '\r\n', '\n' ).replace( '\r', '\n' )
+        if file_check and self.file_pat and not self.file_pat.search( text ):
+            return None
+        return text
+
+    # (line_number, line) のリスト
+    def search_lines( self, full_path, cap ):
+        text= self.read_text( full_path )
+        if text is None:
+            return []
+        result= []
+        for line_number, line in enumerate( io.StringIO( text ), 1 ):
+            if self.pat.search( line ):
+                result.append( (line_number, line.rstrip()) )
+                if len( result ) >= cap:
+                    break
+        return result
+
+    # ファイル全体に対して一致するかどうか
+    def match_file( self, full_path ):
+        text= self.read_text( full_path, False )
+        return text is not None and self.pat.search( text ) is not None
+
+SEARCH_WORKERS= min( 8, (os.cpu_count() or 1) + 4 )
+SEARCH_WINDOW= SEARCH_WORKERS * 4   # 先読みするファイル数
+
+# path_list の各ファイルに func を並列に適用し、結果を path_list の順に返す
+#   stop_func が True を返したら残りは読まない
+def map_files( func, path_list, stop_func= None ):
+    if len( path_list ) <= 1:
+        for path in path_list:
+            result= func( path )
+            yield path, result
+            if stop_func and stop_func():
+                return
+        return
+    with concurrent.futures.ThreadPoolExecutor( max_workers=SEARCH_WORKERS ) as executor:
+        future_list= []
+        next_index= 0
+        try:
+            while next_index < len( path_list ) or future_list:
+                while next_index < len( path_list ) and len( future_list ) < SEARCH_WINDOW:
+                    path= path_list[next_index]
+                    future_list.append( (path, executor.submit( func, path )) )
+                    next_index+= 1
+                path, future= future_list.pop( 0 )
+                yield path, future.result()
+                if stop_func and stop_func():
+                    return
+        finally:
+            for _, future in future_list:
+                future.cancel()
+
+# rel_path_list から pattern に一致する行を探す。"rel_path:line:text" のリストと打ち切ったかどうかを返す
+#   cap 行を超える一致が実際にあったときだけ打ち切ったとする
+def search_files( searcher, root, rel_path_list, cap ):
+    results= []
+    def search_1( rel_path ):
+        return searcher.search_lines( os.path.join( root, rel_path ), cap + 1 )
+    for rel_path, line_list in map_files( search_1, rel_path_list, lambda: len( results ) > cap ):
+        for line_number, line in line_list:
+            results.append( '%s:%d:%s' % (rel_path, line_number, line) )
+            if len( results ) > cap:
+                return results[:cap], True
+    return results, False
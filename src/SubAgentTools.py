@@ -59,7 +59,7 @@ def _max_depth():
 
 mcp= get_toolbox()
 
-@mcp.tool()
+@mcp.tool( serial=True )
 def run_subagent( prompt: str, preset: str ) -> str:
     """Delegate a task to a sub-agent that has its own model, tools, and context.
     Only the sub-agent's final response is returned to you; its intermediate
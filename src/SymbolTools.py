@@ -0,0 +1,395 @@
+# vim:ts=4 sw=4 et:
+
+import os
+import sys
+import re
+import json
+import gzip
+import threading
+
+lib_path= os.path.dirname(__file__)
+if lib_path not in sys.path:
+    sys.path.append( lib_path )
+from Functions import get_toolbox,ToolEnv
+import SourceIndex
+
+# C/C++ のシンボル (class, struct, union, enum, 関数, マクロ, typedef/using) の定義位置を記録する
+#   正規表現による簡易解析なので ctags ほど正確ではない
+#   SourceIndex のファイル一覧を使い、mtime とサイズが変わったファイルだけ読み直す
+
+_CPP_EXTS= frozenset( ['.h', '.hh', '.hpp', '.hxx', '.inl', '.c', '.cc', '.cpp', '.cxx'] )
+_MAX_FILE_SIZE= 2 * 1024 * 1024
+_MAX_DEFINITIONS= 50
+_MAX_REFERENCES= 500
+_MAX_SIGNATURE_LINES= 10
+_INDEX_VERSION= 1
+
+_KEYWORDS= frozenset( ['if', 'for', 'while', 'switch', 'return', 'sizeof', 'catch', 'else', 'do',
+                       'new', 'delete', 'throw', 'case', 'alignof', 'decltype', 'static_assert', 'defined'] )
+
+_RE_DEFINE= re.compile( r'^\s*#\s*define\s+(\w+)' )
+_RE_TYPE= re.compile( r'^\s*(?:template\s*<.*>\s*)?(?:typedef\s+)?(class|struct|union|enum\s+class|enum\s+struct|enum)\s+'
+                      r'(?:[A-Z0-9_]+_API\s+)?(?:alignas\s*\([^)]*\)\s*)?(\w+)\b(.*)' )
+_RE_USING= re.compile( r'^\s*(?:template\s*<.*>\s*)?using\s+(\w+)\s*=' )
+_RE_TYPEDEF= re.compile( r'^\s*typedef\s+[^;(]*?\b(\w+)\s*;' )
+_RE_FUNC= re.compile( r'^[\w:<>,\*&\s~]*?\b((?:\w+\s*::\s*)*~?\w+)\s*\(' )
+_RE_BLOCK_COMMENT= re.compile( r'/\*.*?\*/', re.DOTALL )
+_RE_LINE_COMMENT= re.compile( r'//.*' )
+
+def _strip_comments( text ):
+    # 行番号を保つためにブロックコメント内の改行は残す
+    text= _RE_BLOCK_COMMENT.sub( lambda m: '\n' * m.group( 0 ).count( '\n' ), text )
+    return _RE_LINE_COMMENT.sub( '', text )
+
+def _next_code_line( lines, index ):
+    for i in range( index + 1, min( index + 4, len( lines ) ) ):
+        line= lines[i].strip()
+        if line:
+            return line
+    return ''
+
+# 引数リストの後ろが定義の本体なら閉じ括弧以降の文字列、宣言なら None
+def _get_signature_tail( lines, index, pos ):
+    depth= 1
+    end= min( index + _MAX_SIGNATURE_LINES, len( lines ) )
+    while index < end:
+        line= lines[index]
+        while pos < len( line ):
+            ch= line[pos]
+            pos+= 1
+            if ch == '(':
+                depth+= 1
+            elif ch == ')':
+                depth-= 1
+                if depth == 0:
+                    tail= line[pos:]
+                    body= tail.find( '{' )
+                    semicolon= tail.find( ';' )
+                    if body >= 0 and ( semicolon < 0 or body < semicolon ):
+                        return tail
+                    if semicolon >= 0 or tail.rstrip().endswith( '=' ):
+                        return None
+                    if _next_code_line( lines, index ).startswith( ( '{', ':' ) ):
+                        return tail
+                    return None
+            elif ch == ';' or ch == '{':
+                return None
+        index+= 1
+        pos= 0
+    return None
+
+def _parse_symbols( text ):
+    symbols= []
+    lines= _strip_comments( text ).split( '\n' )
+    for index, line in enumerate( lines ):
+        if not line.strip():
+            continue
+        m= _RE_DEFINE.match( line )
+        if m:
+            symbols.append( ( m.group( 1 ), 'macro', index + 1 ) )
+            continue
+        if line.lstrip().startswith( '#' ):
+            continue
+        m= _RE_TYPE.match( line )
+        if m:
+            kind= m.group( 1 ).split()[0]
+            # { より前に ; があれば前方宣言や変数宣言なので除く
+            rest= m.group( 3 )
+            semicolon= rest.find( ';' )
+            body= rest.find( '{' )
+            if semicolon >= 0 and ( body < 0 or semicolon < body ):
+                continue
+            symbols.append( ( m.group( 2 ), kind, index + 1 ) )
+            continue
+        m= _RE_USING.match( line ) or _RE_TYPEDEF.match( line )
+        if m:
+            symbols.append( ( m.group( 1 ), 'typedef', index + 1 ) )
+            continue
+        # 関数定義: 引数リストの閉じ括弧の後に { が続くもの
+        m= _RE_FUNC.match( line )
+        if m:
+            qualified= re.sub( r'\s+', '', m.group( 1 ) )
+            name= qualified.split( '::' )[-1]
+            if name.lstrip( '~' ) in _KEYWORDS or name.isdigit():
+                continue
+            # 呼び出しや代入の右辺、コンストラクタの初期化子は除く
+            head= line[:m.start( 1 )]
+            if '=' in head or 'return' in head.split() or head.strip().startswith( ( ':', ',' ) ):
+                continue
+            if head.strip() == '' and '::' not in qualified and line[:1].isspace():
+                continue
+            if _get_signature_tail( lines, index, m.end() ) is None:
+                continue
+            symbols.append( ( qualified, 'function', index + 1 ) )
+    return symbols
+
+#------------------------------------------------------------------------------
+
+class SymbolIndex:
+    def __init__( self, source_index ):
+        self.lock= threading.Lock()
+        self.source_index= source_index
+        self.file_map= {}       # rel_path to [mtime_ns, size, [(qualified, kind, line)]]
+        self.name_map= {}       # 小文字の短い名前 to [(rel_path, qualified, kind, line)]
+        self.change_seq= None
+        self.loaded= False
+
+    def get_cache_file( self ):
+        cache_file= self.source_index.get_cache_file()
+        if not cache_file:
+            return None
+        return cache_file.replace( 'files_', 'symbols_' )
+
+    def load_cache_0( self ):
+        cache_file= self.get_cache_file()
+        if not cache_file or not os.path.exists( cache_file ):
+            return
+        try:
+            with gzip.open( cache_file, 'rt', encoding='utf-8' ) as fi:
+                data= json.loads( fi.read() )
+        except (OSError, ValueError):
+            return
+        if data.get( 'version' ) != _INDEX_VERSION or data.get( 'root' ) != self.source_index.root:
+            return
+        self.file_map= data.get( 'files', {} )
+
+    def save_cache_0( self ):
+        cache_file= self.get_cache_file()
+        if not cache_file:
+            return
+        try:
+            os.makedirs( self.source_index.index_dir, exist_ok=True )
+            tmp_file= cache_file + '.%d.tmp' % os.getpid()
+            with gzip.open( tmp_file, 'wt', encoding='utf-8' ) as fo:
+                fo.write( json.dumps( { 'version': _INDEX_VERSION, 'root': self.source_index.root, 'files': self.file_map } ) )
+            os.replace( tmp_file, cache_file )
+        except OSError:
+            pass
+
+    #--------------------------------------------------------------------------
+    # Lock の中から呼ぶ想定の命令
+
+    # SourceIndex.get_changes() で変わったファイルだけ読み直す
+    def update_0( self ):
+        seq, change_map, full= self.source_index.get_changes( self.change_seq )
+        self.change_seq= seq
+        changed= False
+        if full:
+            for rel_path in list( self.file_map.keys() ):
+                if rel_path not in change_map:
+                    del self.file_map[rel_path]
+                    changed= True
+        for rel_path, stat in change_map.items():
+            if os.path.splitext( rel_path )[1].lower() not in _CPP_EXTS:
+                continue
+            if stat is None:
+                if self.file_map.pop( rel_path, None ) is not None:
+                    changed= True
+                continue
+            entry= self.file_map.get( rel_path )
+            if entry and entry[0] == stat[0] and entry[1] == stat[1]:
+                continue
+            symbols= []
+            if stat[1] <= _MAX_FILE_SIZE:
+                try:
+                    with open( os.path.join( self.source_index.root, rel_path ), 'r', encoding='utf-8', errors='ignore' ) as f:
+                        symbols= _parse_symbols( f.read() )
+                except OSError:
+                    continue
+            self.file_map[rel_path]= [stat[0], stat[1], symbols]
+            changed= True
+        return changed
+
+    def rebuild_map_0( self ):
+        name_map= {}
+        for rel_path in sorted( self.file_map.keys() ):
+            for qualified, kind, line in self.file_map[rel_path][2]:
+                name= qualified.split( '::' )[-1].lower()
+                name_map.setdefault( name, [] ).append( ( rel_path, qualified, kind, line ) )
+        self.name_map= name_map
+
+    def refresh_0( self ):
+        if not self.loaded:
+            self.loaded= True
+            self.load_cache_0()
+            self.update_0()
+            self.rebuild_map_0()
+            self.save_cache_0()
+        elif self.update_0():
+            self.rebuild_map_0()
+            self.save_cache_0()
+
+    #--------------------------------------------------------------------------
+
+    # symbol = "Name" または "Class::Name"
+    def find( self, symbol, kind= '' ):
+        symbol= re.sub( r'\s+', '', symbol ).lower()
+        name= symbol.split( '::' )[-1]
+        with self.lock:
+            self.refresh_0()
+            candidate_list= list( self.name_map.get( name, [] ) )
+        result= []
+        for rel_path, qualified, sym_kind, line in candidate_list:
+            if kind and sym_kind != kind:
+                continue
+            if '::' in symbol and not ( '::' + qualified.lower() ).endswith( '::' + symbol ):
+                continue
+            result.append( ( rel_path, qualified, sym_kind, line ) )
+        # ヘッダより実装を先に出す
+        result.sort( key=lambda r: ( os.path.splitext( r[0] )[1].lower() not in ( '.c', '.cc', '.cpp', '.cxx' ) ) )
+        return result
+
+#------------------------------------------------------------------------------
+
+_symbol_lock= threading.Lock()
+_symbol_map= {}
+
+def _get_root( env ):
+    return env.get( 'MCP_FOLDER_ROOT', env.get( 'MCP_SOURCE_ROOT', '' ) )
+
+def _get_symbol_index( root, env ):
+    source_index= SourceIndex.get_index( root, env )
+    with _symbol_lock:
+        symbol_index= _symbol_map.get( source_index.root )
+        if symbol_index is None:
+            symbol_index= SymbolIndex( source_index )
+            _symbol_map[source_index.root]= symbol_index
+        return symbol_index
+
+def _read_line( full, line_no ):
+    try:
+        with open( full, 'r', encoding='utf-8', errors='ignore' ) as f:
+            for index, line in enumerate( f, 1 ):
+                if index == line_no:
+                    return line.strip()
+    except OSError:
+        pass
+    return ''
+
+mcp= get_toolbox()
+
+@mcp.tool()
+def find_definition( env:ToolEnv, symbol: str, kind: str ) -> str:
+    """
+    Find where a C/C++ symbol is defined: class, struct, union, enum, function, macro, or typedef.
+    Much faster than search_text for locating definitions. Returns file paths and line numbers
+    that can be passed to read_file_range.
+
+    Args:
+        symbol: Symbol name, optionally qualified. e.g. "FPlayerState", "UMyComponent::TickComponent", "MAX_PLAYERS"
+        kind: Filter by kind: "class", "struct", "union", "enum", "function", "macro", "typedef". Use empty string for all kinds.
+    """
+    root= _get_root( env )
+    if not root:
+        return 'MCP_FOLDER_ROOT is not set'
+    if not symbol.strip():
+        return 'Empty symbol'
+    symbol_index= _get_symbol_index( root, env )
+    results= symbol_index.find( symbol, kind.strip().lower() )
+    if not results:
+        return 'No definition found for "%s"' % symbol
+    note= ' (showing first %d)' % _MAX_DEFINITIONS if len( results ) > _MAX_DEFINITIONS else ''
+    out= ['**Definitions of "%s"** (%d%s):' % ( symbol, len( results ), note ), '']
+    for rel_path, qualified, sym_kind, line in results[:_MAX_DEFINITIONS]:
+        text= _read_line( os.path.join( symbol_index.source_index.root, rel_path ), line )
+        out.append( '- %s:%d [%s %s] %s' % ( rel_path, line, sym_kind, qualified, text ) )
+    return '\n'.join( out )
+
+@mcp.tool()
+def find_references( env:ToolEnv, symbol: str, directory: str, max_results: int ) -> str:
+    """
+    Find lines in C/C++ sources that refer to a symbol as a whole word. Comments are included.
+    Use find_definition to locate the definition itself.
+
+    Args:
+        symbol: Symbol name. A qualified name such as "Class::Method" searches for "Method".
+        directory: Relative path from the source root to limit the search scope. Use empty string to search all.
+        max_results: Maximum number of matching lines to return. Recommended: 50-200.
+    """
+    root= _get_root( env )
+    if not root:
+        return 'MCP_FOLDER_ROOT is not set'
+    name= re.sub( r'\s+', '', symbol ).split( '::' )[-1]
+    if not re.match( r'^~?\w+$', name ):
+        return 'Invalid symbol: "%s"' % symbol
+    source_index= SourceIndex.get_index( root, env )
+    target= os.path.realpath( os.path.join( source_index.root, directory ) ) if directory else source_index.root
+    rel_dir= source_index.get_rel_dir( target )
+    if rel_dir is None:
+        return 'Invalid path: "%s"' % directory
+    cap= max( 1, min( max_results, _MAX_REFERENCES ) )
+    word= r'\b' if re.match( r'\w', name ) else ''
+    searcher= SourceIndex.TextSearcher( word + re.escape( name ) + r'\b' )
+    file_list= None
+    if SourceIndex.is_search_index_enabled( env ):
+        file_list= SourceIndex.get_trigram_index( root, env ).find_candidates( [name], rel_dir, _CPP_EXTS )
+    if file_list is None:
+        prefix= rel_dir + '/' if rel_dir else ''
+        file_list= [rel_path for rel_path in source_index.get_all_files()
+                        if rel_path.startswith( prefix ) and os.path.splitext( rel_path )[1].lower() in _CPP_EXTS]
+    results, truncated= SourceIndex.search_files( searcher, source_index.root, file_list, cap )
+    if not results:
+        return 'No references found for "%s"' % name
+    note= ', truncated' if truncated else ''
+    header= '**References to "%s"** (%d matches%s):\n\n' % ( name, len( results ), note )
+    return header + '\n'.join( results )
+
+#------------------------------------------------------------------------------
+
+# _parse_symbols の確認用 (--test)
+_TEST_LIST= [
+    ( 'enum class Color { Red, Green };', [('Color', 'enum', 1)] ),
+    ( 'enum EState : uint8 { Idle };', [('EState', 'enum', 1)] ),
+    ( 'struct Point { int x, y; };', [('Point', 'struct', 1)] ),
+    ( 'class Empty {};', [('Empty', 'class', 1)] ),
+    ( 'union Value { int i; float f; };', [('Value', 'union', 1)] ),
+    ( 'class Foo;', [] ),
+    ( 'struct FData* GetData();', [] ),
+    ( 'class MYGAME_API APlayer : public AActor\n{\n};', [('APlayer', 'class', 1)] ),
+    ( '#define MAX_PLAYERS 16', [('MAX_PLAYERS', 'macro', 1)] ),
+    ( 'typedef unsigned int uint32;', [('uint32', 'typedef', 1)] ),
+    ( '/* class Fake {\n */\nusing FPtr = APlayer*;', [('FPtr', 'typedef', 3)] ),
+    ( 'void APlayer::Tick( float DeltaTime )\n{\n}', [('APlayer::Tick', 'function', 1)] ),
+    ( 'APlayer::APlayer()\n    : Score( 0 )\n{\n}', [('APlayer::APlayer', 'function', 1)] ),
+    ( 'static bool helper( int a,\n                    int b )\n{\n}', [('helper', 'function', 1)] ),
+    ( 'int Add( int a, int b );', [] ),
+    ( 'void f()\n{\n    Score= Max( Score, 1 );\n}', [('f', 'function', 1)] ),
+]
+
+def run_test():
+    failed= 0
+    for text, expected in _TEST_LIST:
+        result= _parse_symbols( text )
+        if result != expected:
+            print( 'Failed', repr( text ), result, expected )
+            failed+= 1
+    print( 'SymbolTools test: %d/%d' % ( len( _TEST_LIST ) - failed, len( _TEST_LIST ) ) )
+    return 1 if failed else 0
+
+def usage():
+    print( 'usage: SymbolTools [options] [<symbol>]' )
+    print( '  MCP_FOLDER_ROOT で検索するフォルダを指定する' )
+    print( 'options:' )
+    print( '  --test' )
+    sys.exit( 1 )
+
+def main( argv ):
+    symbol= None
+    test_mode= False
+    for arg in argv[1:]:
+        if arg == '--test':
+            test_mode= True
+        elif arg[0] == '-':
+            usage()
+        else:
+            symbol= arg
+    if test_mode:
+        return run_test()
+    if symbol is None:
+        usage()
+    print( find_definition( os.environ, symbol, '' ) )
+    print( find_references( os.environ, symbol, '', 50 ) )
+    return 0
+
+if __name__=='__main__':
+    sys.exit( main( sys.argv ) )
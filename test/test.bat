@@ -4,6 +4,7 @@ chcp 65001
 set USE_SLACK=0
 
 set USE_TEXTLOADER=1
+set USE_SYMBOLTOOLS=1
 set USE_TEST01=1
 set USE_TEST02=1
 set USE_TEST03=1
@@ -77,6 +78,8 @@ python TextLoader.py test/data_sample.json --test
 python TextLoader.py config.sample.txt --test
 )
 
+if %USE_SYMBOLTOOLS% == 1 python src/SymbolTools.py --test
+
 if %USE_TEST01% == 1 python src/Assistant.py %BASE_OPTIONS%  --preset test01 --input input/test01.txt
 
 if %USE_TEST02% == 1 python src/Assistant.py %BASE_OPTIONS%  --preset test02 --input input/test02.json
@@ -3,6 +3,7 @@
 USE_SLACK=0
 
 USE_TEXTLOADER=1
+USE_SYMBOLTOOLS=1
 USE_TEST01=1
 USE_TEST02=1
 USE_TEST03=1
@@ -92,6 +93,10 @@ python3 src/TextLoader.py test/data_sample.json --test
 python3 src/TextLoader.py config.sample.txt --test
 fi
 
+if [ $USE_SYMBOLTOOLS = 1 ];then
+python3 src/SymbolTools.py --test
+fi
+
 #------------------------------------------------------------------------------
 
 # tool calling